@@ -0,0 +1,359 @@
+# Note: this module is python2 and python 3 compatible.
+#
+# fiolog.py
+#
+# Log reading code shared by tools/fiologparser.py,
+# tools/hist/fiologparser_hist.py and tools/plot/fio2gnuplot, and the
+# histogram bin tables of fiologparser_hist.py and
+# tools/hist/fio-histo-log-pctiles.py.  It is
+# installed next to them, and the tools in subdirectories of tools/ add
+# tools/ to sys.path to find it in the source tree.
+
+from __future__ import absolute_import
+import io
+import os
+import stat
+import tempfile
+import zlib
+try:
+    import numpy as np
+except ImportError:
+    # the .fz reader is all fio2gnuplot needs
+    np = None
+
+# Logs written with log_store_compressed=1 (".fz" files) are a sequence
+# of independently zlib-compressed chunks.  Rather than requiring them to
+# be expanded with "fio --inflate-log" first, they are decoded on the fly
+# while being read.  Each read decompresses no more than the caller asked
+# for, keeping the compressed input it did not need yet, so memory stays
+# bounded by one input chunk and one read however well the log compresses.
+
+def is_compressed(fn):
+    return fn.endswith('.fz')
+
+class InflateReader(io.RawIOBase):
+    """ Raw binary reader returning the decompressed contents of a .fz log. """
+    def __init__(self, fn, chunk=1 << 20):
+        self.f = open(fn, 'rb')
+        self.chunk = chunk
+        self.z = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.pending = b''
+        self.buf = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf:
+            if not self.pending:
+                self.pending = self.f.read(self.chunk)
+                if not self.pending:
+                    # whatever the last stream still holds back
+                    self.buf = self.z.flush()
+                    if not self.buf:
+                        return 0
+                    break
+            self.buf = self.z.decompress(self.pending, len(b))
+            if self.z.unused_data:
+                # the previous stream ended, the next one starts here
+                self.pending = self.z.unused_data
+                self.z = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            else:
+                self.pending = self.z.unconsumed_tail
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+        io.RawIOBase.close(self)
+
+def open_log(fn):
+    """ Open a log for reading in binary mode, decompressing .fz logs. """
+    if is_compressed(fn):
+        return io.BufferedReader(InflateReader(fn))
+    return open(fn, 'rb')
+
+# bytes of log text converted to integers at a time
+BLOCK_SIZE = 1 << 24
+
+def parse_block(fn, data, ncols):
+    """ Convert a block of complete log lines into an integer matrix. """
+    lines = data.count(b'\n') + 1
+    try:
+        vals = np.fromstring(data.replace(b'\n', b','), dtype=np.int64, sep=',')
+    except ValueError:
+        vals = None
+    if vals is None or len(vals) != lines * ncols:
+        raise ValueError('%s: malformed log, expected %d integer columns per line' % (fn, ncols))
+    return vals.reshape(lines, ncols)
+
+def parse_log(fn, offset=0, end=None, ncols_allowed=None):
+    """ Yield the integer matrix of fn in blocks of about BLOCK_SIZE bytes
+        of log text, each converted to integers in one go.  The number of
+        columns is taken from the first line, and must be one of
+        ncols_allowed if given.  Uncompressed logs may be read from byte
+        offset up to byte end, which must both be line boundaries. """
+    ncols = None
+    rest = b''
+    with open_log(fn) as f:
+        if offset:
+            f.seek(offset)
+        left = None if end is None else end - offset
+        eof = False
+        while not eof:
+            data = f.read(BLOCK_SIZE if left is None else min(BLOCK_SIZE, left))
+            if left is not None:
+                left -= len(data)
+            eof = not data
+            data = rest + data
+            cut = len(data) if eof else data.rfind(b'\n') + 1
+            data, rest = data[:cut].strip(), data[cut:]
+            if not data:
+                continue
+            if ncols is None:
+                ncols = data.split(b'\n', 1)[0].count(b',') + 1
+                if ncols_allowed is not None and ncols not in ncols_allowed:
+                    raise ValueError('%s: unsupported log format with %d columns' % (fn, ncols))
+            yield parse_block(fn, data, ncols)
+
+# Parsed logs are cached in a hidden file next to each log, named
+# ".<log name>.cache", so that re-running a tool with a different
+# --interval or --percentiles does not parse the log text again.  The
+# header records the size and modification time of the log the cache was
+# built from; a cache which no longer matches its log is ignored and
+# rebuilt.
+#
+# The integer matrix of the log is kept in blocks, as it was parsed, and
+# encoded compactly so that the cache is smaller than the log text:
+#  - the first dense_cols columns one after the other, each as the
+#    narrowest integer type holding its values
+#  - any further columns, which for histogram logs are the mostly-empty
+#    latency bins, as their nonzero entries: the number of entries of
+#    every row, then their column indexes, then their values, again each
+#    as the narrowest integer type that fits.
+# Every array is preceded by its item size and length and padded to 8
+# bytes.  An index of the blocks at the end of the file gives the offset,
+# row count and first and last time of each, so a reader can skip to the
+# blocks it needs.  The file is memory-mapped, and each block is decoded
+# when it is read.
+
+CACHE_MAGIC = b'FIOLOGC2'
+CACHE_FIELDS = 7    # log size, log mtime, rows, cols, dense_cols, blocks, index offset
+CACHE_HEADER = len(CACHE_MAGIC) + CACHE_FIELDS * 8
+
+def cache_path(fn):
+    head, tail = os.path.split(fn)
+    return os.path.join(head, '.' + tail + '.cache')
+
+def log_stamp(fn):
+    st = os.stat(fn)
+    return st.st_size, getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
+
+def narrowest(a):
+    """ Return a as the narrowest signed integer type holding its values. """
+    if len(a) > 0:
+        lo, hi = a.min(), a.max()
+        for t in (np.int8, np.int16, np.int32):
+            if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max:
+                return a.astype(t)
+        return a.astype(np.int64)
+    return a.astype(np.int8)
+
+class LogCache(object):
+    """ The memory-mapped cache of a log, as returned by load_cache(). """
+    def __init__(self, path, rows, cols, dense_cols, nblocks, index_offset):
+        self.rows, self.cols, self.dense_cols = rows, cols, dense_cols
+        self.mm = np.memmap(path, dtype=np.uint8, mode='r')
+        index, _ = self.read_array(index_offset)
+        self.index = index.reshape(nblocks, 4)
+        self.first_time = int(self.index[0, 2]) if nblocks else None
+        self.last_time = int(self.index[-1, 3]) if nblocks else None
+
+    def read_array(self, pos):
+        """ Return the array at byte pos and the position following it. """
+        itemsize, count = [int(x) for x in self.mm[pos:pos + 16].view(np.int64)]
+        pos += 16
+        size = itemsize * count
+        a = self.mm[pos:pos + size].view({1: np.int8, 2: np.int16, 4: np.int32, 8: np.int64}[itemsize])
+        return a, pos + size + (-size % 8)
+
+    def decode(self, pos, rows):
+        """ Return the block at byte pos as an integer matrix. """
+        vals = np.zeros((rows, self.cols), dtype=np.int64)
+        for j in range(self.dense_cols):
+            vals[:, j], pos = self.read_array(pos)
+        if self.cols > self.dense_cols:
+            counts, pos = self.read_array(pos)
+            idx, pos = self.read_array(pos)
+            nonzero, pos = self.read_array(pos)
+            vals[np.repeat(np.arange(rows), counts), self.dense_cols + idx.astype(np.intp)] = nonzero
+        return vals
+
+    def blocks(self, after=None):
+        """ Yield the integer matrix of the log in blocks.  With after, only
+            the rows later than that time are yielded. """
+        for pos, rows, first, last in self.index.tolist():
+            if after is not None and last <= after:
+                continue
+            vals = self.decode(pos, rows)
+            if after is not None and first <= after:
+                vals = vals[np.searchsorted(vals[:, 0], after, side='right'):]
+            yield vals
+
+def load_cache(fn):
+    """ Return the LogCache of fn, or None if there is no valid cache. """
+    try:
+        with open(cache_path(fn), 'rb') as f:
+            header = f.read(CACHE_HEADER)
+        stamp = log_stamp(fn)
+    except (IOError, OSError):
+        return None
+    if len(header) != CACHE_HEADER or header[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+        return None
+    fields = [int(x) for x in np.frombuffer(header[len(CACHE_MAGIC):], dtype=np.int64)]
+    if tuple(fields[:2]) != stamp:
+        return None
+    try:
+        return LogCache(cache_path(fn), *fields[2:])
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+class CacheWriter(object):
+    """ Write the cache of fn block by block, keeping the first dense_cols
+        columns (all of them if None) dense.  The cache only replaces an
+        existing one on commit(), and failures to write it are ignored. """
+    def __init__(self, fn, dense_cols=None):
+        self.fn = fn
+        self.dense_cols = dense_cols
+        self.rows, self.cols = 0, 0
+        self.index = []
+        self.f = None
+        try:
+            self.stamp = log_stamp(fn)
+            fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(cache_path(fn)) or '.',
+                                            prefix='.fiolog')
+            self.f = os.fdopen(fd, 'wb')
+            # readable by whoever can read the log, not only by us
+            os.chmod(self.tmp, stat.S_IMODE(os.stat(fn).st_mode) & 0o666)
+            self.f.write(b'\0' * CACHE_HEADER)
+        except (IOError, OSError):
+            self.abort()
+
+    def write_array(self, a):
+        data = np.ascontiguousarray(a).tobytes()
+        self.f.write(np.array([a.dtype.itemsize, len(a)], dtype=np.int64).tobytes())
+        self.f.write(data + b'\0' * (-len(data) % 8))
+
+    def append(self, vals):
+        if self.f is None or len(vals) == 0:
+            return
+        try:
+            self.cols = vals.shape[1]
+            dense_cols = self.cols if self.dense_cols is None else min(self.dense_cols, self.cols)
+            self.index.append((self.f.tell(), len(vals), vals[0, 0], vals[-1, 0]))
+            for j in range(dense_cols):
+                self.write_array(narrowest(vals[:, j]))
+            if self.cols > dense_cols:
+                rest = vals[:, dense_cols:]
+                rows, idx = np.nonzero(rest)
+                self.write_array(narrowest(np.bincount(rows, minlength=len(vals))))
+                self.write_array(narrowest(idx))
+                self.write_array(narrowest(rest[rows, idx]))
+            self.rows += len(vals)
+        except (IOError, OSError):
+            self.abort()
+
+    def commit(self):
+        if self.f is None:
+            return
+        try:
+            if log_stamp(self.fn) != self.stamp:
+                # the log changed while we read it
+                self.abort()
+                return
+            index_offset = self.f.tell()
+            self.write_array(np.array(self.index, dtype=np.int64).reshape(-1))
+            dense_cols = self.cols if self.dense_cols is None else min(self.dense_cols, self.cols)
+            self.f.seek(0)
+            self.f.write(CACHE_MAGIC)
+            self.f.write(np.array(self.stamp + (self.rows, self.cols, dense_cols, len(self.index),
+                                                index_offset), dtype=np.int64).tobytes())
+            self.f.close()
+            self.f = None
+            os.rename(self.tmp, cache_path(self.fn))
+        except (IOError, OSError):
+            self.abort()
+
+    def abort(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            try:
+                os.unlink(self.tmp)
+            except OSError:
+                pass
+
+# The latencies of the bins of fio latency histograms, see stat.h.
+
+def _plat_idx_to_val(idx, edge=0.5, FIO_IO_U_PLAT_BITS=6):
+    """ Taken from fio's stat.c for calculating the latency value of a bin
+        from that bin's index.  idx may be an array of indices, which are
+        all converted at once.
+        
+            idx  : the value of the index into the histogram bins
+            edge : fractional value in the range [0,1]** indicating how far into
+            the bin we wish to compute the latency value of.
+        
+        ** edge = 0.0 and 1.0 computes the lower and upper latency bounds
+           respectively of the given bin index. """
+    FIO_IO_U_PLAT_VAL = 1 << FIO_IO_U_PLAT_BITS
+    idx = np.asarray(idx, dtype=np.int64)
+
+    # Find the group and compute the minimum value of that group
+    error_bits = np.maximum((idx >> FIO_IO_U_PLAT_BITS) - 1, 0)
+    base = np.left_shift(1, error_bits + FIO_IO_U_PLAT_BITS)
+
+    # Find its bucket number of the group
+    k = idx % FIO_IO_U_PLAT_VAL
+
+    # MSB <= (FIO_IO_U_PLAT_BITS-1), cannot be rounded off. Use
+    # all bits of the sample as index.  Otherwise return the mean
+    # (if edge=0.5) of the range of the bucket
+    return np.where(idx < (FIO_IO_U_PLAT_VAL << 1), idx,
+                    base + ((k + edge) * np.left_shift(1, error_bits)))
+    
+def plat_idx_to_val_coarse(idx, coarseness, edge=0.5, bits=6):
+    """ Converts the given *coarse* index into a non-coarse index as used by fio
+        in stat.h:plat_idx_to_val(), subsequently computing the appropriate
+        latency value for that bin.
+        """
+
+    # Multiply the index by the power of 2 coarseness to get the bin
+    # bin index with a max of 1536 bins (FIO_IO_U_PLAT_GROUP_NR = 24 in stat.h)
+    stride = 1 << coarseness
+    idx = np.asarray(idx, dtype=np.int64) * stride
+    lower = _plat_idx_to_val(idx, edge=0.0, FIO_IO_U_PLAT_BITS=bits)
+    upper = _plat_idx_to_val(idx + stride, edge=1.0, FIO_IO_U_PLAT_BITS=bits)
+    return lower + (upper - lower) * edge
+
+_bin_tables = {}
+
+def bin_table(group_nr, bits=6, coarseness=0, unit=1):
+    """ Return the latencies of the bins of a histogram of group_nr groups
+        of 2**bits bins, merged 2**coarseness at a time, divided by unit.
+        The rows of the table are the plat_idx_to_val_coarse() values of
+        every bin for edge = 0.0, 0.5 and 1.0, and its columns the bins,
+        plus one past the last, whose lower edge is where the last bin
+        ends.  Tables are computed once per process and are read-only. """
+    key = (group_nr, bits, coarseness, unit)
+    table = _bin_tables.get(key)
+    if table is None:
+        idx = np.arange(((group_nr << bits) >> coarseness) + 1)
+        table = np.array([plat_idx_to_val_coarse(idx, coarseness, edge, bits)
+                          for edge in (0.0, 0.5, 1.0)], dtype=float) / unit
+        table.flags.writeable = False
+        _bin_tables[key] = table
+    return table
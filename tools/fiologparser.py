@@ -1,5 +1,5 @@
 #!/usr/bin/python2.7
-# Note: this script is python2 and python 3 compatible.
+# Note: this script is python2 and python 3 compatible, and requires numpy.
 #
 # fiologparser.py
 #
@@ -12,14 +12,40 @@
 #
 # fiologparser.py -a *clat*
 #
-# to see per-interval average completion latency.
+# to see per-interval average completion latency, or:
+#
+# fiologparser.py -s --directions rw *bw*
+#
+# to see the read and write bandwidth sums of a randrw run separately, or:
+#
+# fiologparser.py -i 1000 --rolling 30000 *bw*
+#
+# to see the moving average, standard deviation, min and max of the total
+# bandwidth over a 30 second window sliding in 1 second steps.
+#
+# To run the unit tests, set the UNITTEST environment variable to anything
+# and pass no other arguments.
 
 from __future__ import absolute_import
 from __future__ import print_function
 import argparse
+import collections
+import heapq
 import math
+import multiprocessing
+import os
+import re
+import sys
+import numpy as np
+from fiolog import is_compressed, load_cache, parse_log, CacheWriter
 
-def parse_args():
+unittest2_imported = True
+try:
+    import unittest2
+except ImportError:
+    unittest2_imported = False
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--interval', required=False, type=int, default=1000, help='interval of time in seconds.')
     parser.add_argument('-d', '--divisor', required=False, type=int, default=1, help='divide the results by this value.')
@@ -28,196 +54,987 @@ def parse_args():
                         help='print all stats for each interval.')
     parser.add_argument('-a', '--average', dest='average', action='store_true', default=False, help='print the average for each interval.')
     parser.add_argument('-s', '--sum', dest='sum', action='store_true', default=False, help='print the sum for each interval.')
+    parser.add_argument('-r', '--rolling', dest='rolling', type=int, default=None, metavar='WINDOW',
+                        help='print the moving average, standard deviation, min and max of the per-interval sums '
+                             'over a sliding window of WINDOW, which slides by one interval at a time. '
+                             'WINDOW is in the same unit as --interval and must be a multiple of it.')
+    parser.add_argument('-p', '--percentiles', dest='percentiles', default='90:95:99',
+                        help='comma or colon separated percentiles printed by --all. min, median and max are always printed.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--stream', dest='stream', action='store_true', default=False,
+                      help='stream through the files in time order, keeping only the samples of unfinished intervals in memory.')
+    mode.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                      help='number of worker processes used to parse and bin the files.')
+    quantiles = parser.add_mutually_exclusive_group()
+    quantiles.add_argument('--sketch', dest='sketch', action='store_true', default=False,
+                           help='estimate --all percentiles from a log-bucketed sketch. Every percentile is then within '
+                                'a relative error of --sketch-accuracy of its exact value; min, avg and max stay exact.')
+    quantiles.add_argument('--exact', dest='sketch', action='store_false',
+                           help='compute exact --all percentiles from the sample values (the default).')
+    parser.add_argument('--sketch-accuracy', dest='sketch_accuracy', type=float, default=0.01, metavar='ACC',
+                        help='relative error of the --sketch percentiles (default 0.01).')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', default=True,
+                        help='do not read or write the parsed log cache files.')
+    parser.add_argument('--directions', dest='directions', default=None,
+                        help='report the data directions given as any combination of r (read), w (write), '
+                             't (trim) and m (mixed) separately, adding a dir column to the output.')
     parser.add_argument("FILE", help="collectl log output files to parse", nargs="+")
+    return parser
+
+def check_args(args):
+    """ Validate and normalize the options in args, raising ValueError. """
+    if args.directions is not None:
+        args.directions = args.directions.lower()
+        if not args.directions or set(args.directions) - set(DIRECTIONS + 'm'):
+            raise ValueError("--directions takes a combination of the characters 'rwtm'")
+    if args.rolling is not None and (args.rolling <= 0 or args.rolling % args.interval):
+        raise ValueError('--rolling must be a positive multiple of --interval')
+    if not 0 < args.sketch_accuracy < 1:
+        raise ValueError('--sketch-accuracy must be between 0 and 1')
+
+def parse_args():
+    parser = build_parser()
     args = parser.parse_args()
+    try:
+        check_args(args)
+    except ValueError as e:
+        parser.error(str(e))
 
     return args
 
 def get_ftime(series):
-    ftime = 0
-    for ts in series:
-        if ftime == 0 or ts.last.end < ftime:
-            ftime = ts.last.end
-    return ftime
+    return min_end(ts.last_end for ts in series)
 
-def print_full(ctx, series):
-    ftime = get_ftime(series)
-    start = 0 
-    end = ctx.interval
+def min_end(ends):
+    """ Return the smallest of the last end times of a set of series.  A
+        series without any samples (ending at 0) does not limit the others. """
+    ends = [end for end in ends if end]
+    return min(ends) if ends else 0
 
-    while (start < ftime):
-        end = ftime if ftime < end else end
-        results = [ts.get_value(start, end) for ts in series]
-        print("%s, %s" % (end, ', '.join(["%0.3f" % i for i in results])))
+def get_intervals(ctx, ftime, first=0):
+    """ Yield the (start, end) bounds of each interval up to ftime,
+        beginning with interval number first.  The last interval is
+        truncated so that it ends at ftime. """
+    start = first * ctx.interval
+    while start < ftime:
+        yield start, min(start + ctx.interval, ftime)
         start += ctx.interval
-        end += ctx.interval
 
-def print_sums(ctx, series):
+def interval_count(ctx, ftime):
+    return max(0, (ftime + ctx.interval - 1) // ctx.interval)
+
+# Interval segmentation engine.
+#
+# Rather than asking every TimeSeries for its value once per interval
+# (which walks all of its samples each time, O(samples * intervals)),
+# we make a single vectorized pass through the sample columns of each
+# series.  The interval index of a sample follows directly from its
+# start and end times, so no search is needed.  A sample's contribution
+# is split into a head (the part in its first interval), a tail (the
+# part in its last interval) and the whole intervals in between; the
+# latter are accumulated with a difference array and a cumulative sum.
+
+def interval_lengths(ctx, ftime, first=0):
+    """ Return the length of each interval up to ftime, beginning with
+        interval number first. """
+    starts = np.arange(first, interval_count(ctx, ftime), dtype=np.int64) * ctx.interval
+    return np.minimum(starts + ctx.interval, ftime) - starts
+
+def segment_values(ctx, ts, ftime, first=0):
+    """ Return the value of ts for every interval up to ftime, beginning
+        with interval number first.  Samples spanning an interval boundary
+        are split pro rata across the intervals they overlap. """
+    width = ctx.interval
+    base = first
+    count = max(0, interval_count(ctx, ftime) - base)
+    start = np.maximum(ts.start, base * width)
+    end = np.minimum(ts.end, ftime)
+    keep = end > start
+    start, end, value = start[keep], end[keep], ts.value[keep].astype(float)
+
+    # interval numbers below are relative to base
+    start, end = start - base * width, end - base * width
+    first = start // width
+    last = (end - 1) // width
+    single = first == last
+    span = ~single
+
+    totals = np.zeros(count)
+    totals += np.bincount(first[single], minlength=count,
+                          weights=value[single] * (end[single] - start[single]))
+
+    first, last, start, end, value = first[span], last[span], start[span], end[span], value[span]
+    totals += np.bincount(first, minlength=count,
+                          weights=value * ((first + 1) * width - start))
+    totals += np.bincount(last, minlength=count,
+                          weights=value * (end - last * width))
+    inner = (np.bincount(first + 1, minlength=count + 1, weights=value) -
+             np.bincount(last, minlength=count + 1, weights=value))
+    totals += np.cumsum(inner)[:count] * width
+
+    return totals / interval_lengths(ctx, ftime, base) / ctx.divisor
+
+def segment_samples(ctx, ts, ftime, first=0):
+    """ Return, for every interval up to ftime beginning with interval
+        number first, the array of sample values lying entirely within
+        that interval. """
+    width = ctx.interval
+    count = interval_count(ctx, ftime)
+    start, end, value = ts.start, ts.end, ts.value
+    idx = start // width
+    inside = ((idx >= first) & (end >= start) & (idx < count) &
+              (end <= np.minimum((idx + 1) * width, ftime)))
+    # a zero length sample sitting on a boundary belongs to both
+    # of the intervals sharing that boundary
+    boundary = ((start == end) & (start % width == 0) &
+                (idx > first) & (idx <= count))
+    idx = np.concatenate((idx[inside], idx[boundary] - 1)) - first
+    count = max(0, count - first)
+    if count == 0:
+        return []
+    vals = np.concatenate((value[inside], value[boundary]))
+
+    order = np.argsort(idx, kind='mergesort')
+    splits = np.searchsorted(idx[order], np.arange(1, count))
+    return np.split(vals[order], splits)
+
+# Data directions.
+#
+# With --directions, the samples of each data direction (the third column
+# of a log) form a series of their own, exactly as if the log had been
+# filtered down to that direction beforehand: a sample starts where the
+# previous sample of the same direction ended.  The mixed direction 'm'
+# is the log as a whole.  Every file is still read only once; its blocks
+# are split by direction as they are read, and the directions are then
+# binned independently, each up to the end of its own shortest series.
+
+DIRECTIONS = 'rwt'  # indexed by the ddir column of the log
+
+def get_directions(ctx):
+    """ Return the directions to report, sorted like fiologparser_hist.py
+        prints them. """
+    if not getattr(ctx, 'directions', None):
+        return ['m']
+    return sorted(set(ctx.directions))
+
+def merge_directions(intervals):
+    """ Merge a dict of per-direction iterators of (start, end, results)
+        into one iterator of (start, end, dir, results), ordered by interval
+        and then by direction. """
+    def tagged(ddir, rows):
+        for start, end, results in rows:
+            yield start, ddir, end, results
+    merged = heapq.merge(*[tagged(ddir, intervals[ddir]) for ddir in sorted(intervals)])
+    for start, ddir, end, results in merged:
+        yield start, end, ddir, results
+
+def direction_values(ctx, series):
+    """ Yield (start, end, values) for each interval, where values holds
+        the value of every series over that interval. """
     ftime = get_ftime(series)
-    start = 0
-    end = ctx.interval
+    columns = [segment_values(ctx, ts, ftime) for ts in series]
+    for idx, (start, end) in enumerate(get_intervals(ctx, ftime)):
+        yield start, end, [column[idx] for column in columns]
 
-    while (start < ftime):
-        end = ftime if ftime < end else end
-        results = [ts.get_value(start, end) for ts in series]
-        print("%s, %0.3f" % (end, sum(results)))
-        start += ctx.interval
-        end += ctx.interval
+def interval_values(ctx, series):
+    """ Yield (start, end, dir, values) for each interval and direction,
+        where series maps every direction to its TimeSeries, one per file. """
+    return merge_directions(dict((ddir, direction_values(ctx, s))
+                                 for ddir, s in series.items()))
 
-def print_averages(ctx, series):
+def segment_sketches(ctx, ts, ftime, first=0):
+    """ Like segment_samples(), but summarize the sample values of every
+        interval in a LogSketch. """
+    return [LogSketch.from_values(ctx.sketch_accuracy, values)
+            for values in segment_samples(ctx, ts, ftime, first)]
+
+def sample_segmenter(ctx):
+    """ Return the segment function and the matching merge function used
+        to gather the samples of each interval. """
+    if getattr(ctx, 'sketch', None):
+        return segment_sketches, LogSketch.merged
+    return segment_samples, np.concatenate
+
+def direction_samples(ctx, series):
+    """ Yield (start, end, values) for each interval, where values holds
+        the values of all samples of all series within that interval
+        (or their LogSketch with --sketch). """
+    segment, merge = sample_segmenter(ctx)
     ftime = get_ftime(series)
-    start = 0
-    end = ctx.interval
+    columns = [segment(ctx, ts, ftime) for ts in series]
+    for idx, (start, end) in enumerate(get_intervals(ctx, ftime)):
+        yield start, end, merge([column[idx] for column in columns])
 
-    while (start < ftime):
-        end = ftime if ftime < end else end
-        results = [ts.get_value(start, end) for ts in series]
-        print("%s, %0.3f" % (end, float(sum(results))/len(results)))
-        start += ctx.interval
-        end += ctx.interval
-
-# FIXME: this routine is computationally inefficient
-# and has O(N^2) behavior
-# it would be better to make one pass through samples
-# to segment them into a series of time intervals, and
-# then compute stats on each time interval instead.
-# to debug this routine, use
+def interval_samples(ctx, series):
+    """ Like interval_values(), but yield the samples of each interval
+        and direction as direction_samples() does. """
+    return merge_directions(dict((ddir, direction_samples(ctx, s))
+                                 for ddir, s in series.items()))
+
+# Streaming engine.
+#
+# Instead of loading every file before the first interval is printed,
+# read the files block by block in a time-ordered k-way merge: the next
+# block is always taken from the file which is furthest behind.  Every
+# file has a watermark, the largest end time read from it so far; as
+# later samples of a file start where the previous one ended, no sample
+# yet to be read can touch an interval ending before the smallest
+# watermark.  Such intervals are emitted at once and samples lying wholly
+# before them are dropped, so memory depends on the interval width and
+# the number of files, not on the length of the run.  With --directions,
+# every direction is merged on its own, all of them taking their blocks
+# from a single reader of each file.
+
+def stream_intervals(ctx, readers, segment):
+    """ Yield (start, end, results) for each interval, where results holds
+        segment()'s result for that interval for every block reader. """
+    width = ctx.interval
+    pending = [Columns.empty() for reader in readers]
+    marks = [0] * len(readers)
+    ftime = None    # smallest last end time among the exhausted readers
+    heap = [(0, i) for i in range(len(readers))]
+    done = 0
+
+    while heap:
+        mark, i = heapq.heappop(heap)
+        if ftime is not None and mark >= ftime:
+            # samples beyond the shortest series are never reported
+            break
+        block = next(readers[i], None)
+        if block is None:
+            if mark:
+                ftime = mark if ftime is None else min(ftime, mark)
+            else:
+                # as in get_ftime(), an empty series does not limit the others
+                marks[i] = None
+            continue
+        pending[i] = pending[i].extend(block)
+        marks[i] = max(mark, int(block.end.max()))
+        heapq.heappush(heap, (marks[i], i))
+
+        # a zero length sample may still land on the boundary at the
+        # smallest watermark, so only emit intervals ending before it
+        upto = (min_mark(marks) - 1) // width
+        if upto > done:
+            columns = [segment(ctx, p, upto * width, done) for p in pending]
+            for idx, (start, end) in enumerate(get_intervals(ctx, upto * width, done)):
+                yield start, end, [column[idx] for column in columns]
+            pending = [p.since(upto * width) for p in pending]
+            done = upto
+
+    for reader in readers:
+        reader.close()
+
+    ftime = min_mark(marks)
+    columns = [segment(ctx, p, ftime, done) for p in pending]
+    for idx, (start, end) in enumerate(get_intervals(ctx, ftime, done)):
+        yield start, end, [column[idx] for column in columns]
+
+def min_mark(marks):
+    marks = [mark for mark in marks if mark is not None]
+    return min(marks) if marks else 0
+
+class DirectionSplitter(object):
+    """ Read the blocks of a log once, handing out the samples of each
+        direction to a separate block reader.  Blocks are only queued
+        until the reader of their direction takes them, and as every
+        reader is consumed in time order the queues stay short. """
+    def __init__(self, fn, directions, cache=True):
+        self.blocks = read_blocks(fn, cache)
+        self.queues = dict((ddir, collections.deque()) for ddir in directions)
+        self.p_times = dict((ddir, 0) for ddir in directions)
+
+    def reader(self, ddir):
+        queue = self.queues[ddir]
+        while True:
+            if queue:
+                yield queue.popleft()
+                continue
+            block = next(self.blocks, None)
+            if block is None:
+                return
+            for d, q in self.queues.items():
+                part = block.direction(d, self.p_times[d])
+                if len(part.end):
+                    q.append(part)
+                    self.p_times[d] = part.end[-1]
+
+    def close(self):
+        self.blocks.close()
+
+def stream_directions(ctx, files, segment):
+    """ Yield (start, end, dir, results) for each interval and direction,
+        where results holds segment()'s result for every file. """
+    directions = get_directions(ctx)
+    splitters = [DirectionSplitter(fn, directions, getattr(ctx, 'cache', True)) for fn in files]
+    try:
+        intervals = merge_directions(dict(
+            (ddir, stream_intervals(ctx, [s.reader(ddir) for s in splitters], segment))
+            for ddir in directions))
+        for row in intervals:
+            yield row
+    finally:
+        for splitter in splitters:
+            splitter.close()
+
+def stream_values(ctx, files):
+    """ Streaming counterpart of interval_values(). """
+    return stream_directions(ctx, files, segment_values)
+
+def stream_samples(ctx, files):
+    """ Streaming counterpart of interval_samples(). """
+    segment, merge = sample_segmenter(ctx)
+    for start, end, ddir, columns in stream_directions(ctx, files, segment):
+        yield start, end, ddir, merge(columns)
+
+# Parallel engine.
+#
+# With many input files, each one is parsed and binned into intervals by
+# a pool of worker processes, which only send back the per-interval
+# values of their file.  The interval grid has to be the same for every
+# file, so the end time of the shortest file is found beforehand by
+# reading the last line of each file (with --directions, the last line
+# of each direction).
+
+def line_direction(line):
+    """ Return the direction of a log line, as a character of DIRECTIONS. """
+    ddir = int(line.split(b',')[2])
+    return DIRECTIONS[ddir] if 0 <= ddir < len(DIRECTIONS) else None
+
+def get_last_times(fn, directions):
+    """ Return the time of the last sample of each of directions in fn,
+        reading the log backwards only until every direction was seen. """
+    if is_compressed(fn):
+        return get_last_times_compressed(fn, directions)
+    times = dict((ddir, 0) for ddir in directions)
+    missing = set(directions)
+    with open(fn, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = b''
+        while pos > 0 and missing:
+            step = min(pos, 4096)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + tail).split(b'\n')
+            # the first line may be incomplete unless at the start of the log
+            tail = lines.pop(0) if pos > 0 else b''
+            for line in reversed(lines):
+                if not line.strip():
+                    continue
+                for ddir in missing & set(['m', line_direction(line)]):
+                    times[ddir] = int(line.split(b',')[0])
+                    missing.discard(ddir)
+    return times
+
+def get_last_times_compressed(fn, directions):
+    """ A compressed log cannot be read backwards, so take the time of its
+        last samples from its cache, or else decode it block by block. """
+    cache = load_cache(fn)
+    blocks = cache.blocks() if cache is not None else parse_log(fn, ncols_allowed=(4, 5))
+    times = dict((ddir, 0) for ddir in directions)
+    for block in blocks:
+        for ddir in directions:
+            if ddir == 'm':
+                rows = block[:, 0]
+            else:
+                rows = block[block[:, 2] == DIRECTIONS.index(ddir), 0]
+            if len(rows):
+                times[ddir] = int(rows[-1])
+    return times
+
+def segment_file(args):
+    """ Pool worker: parse a file and segment each direction of it into
+        intervals. """
+    ctx, fn, ftimes, segment = args
+    series = read_series(ctx, fn, list(ftimes))
+    return dict((ddir, segment(ctx, series[ddir], ftime)) for ddir, ftime in ftimes.items())
+
+def pool_intervals(ctx, files, segment):
+    """ Yield (start, end, dir, results) for each interval and direction,
+        where results holds segment()'s result for every file. """
+    directions = get_directions(ctx)
+    last = [get_last_times(fn, directions) for fn in files]
+    ftimes = dict((ddir, min_end(times[ddir] for times in last)) for ddir in directions)
+    pool = multiprocessing.Pool(min(ctx.jobs, len(files)))
+    try:
+        columns = pool.map(segment_file, [(ctx, fn, ftimes, segment) for fn in files], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    def intervals(ddir):
+        for idx, (start, end) in enumerate(get_intervals(ctx, ftimes[ddir])):
+            yield start, end, [column[ddir][idx] for column in columns]
+    return merge_directions(dict((ddir, intervals(ddir)) for ddir in directions))
+
+def pool_values(ctx, files):
+    """ Parallel counterpart of interval_values(). """
+    return pool_intervals(ctx, files, segment_values)
+
+def pool_samples(ctx, files):
+    """ Parallel counterpart of interval_samples(). """
+    segment, merge = sample_segmenter(ctx)
+    for start, end, ddir, columns in pool_intervals(ctx, files, segment):
+        yield start, end, ddir, merge(columns)
+
+def row_label(ctx, time, ddir):
+    """ Return the leading columns of an output row: the time, followed
+        by the direction with --directions. """
+    if ctx.directions:
+        return "%s, %s" % (time, ddir)
+    return "%s" % time
+
+def print_full(ctx, intervals):
+    for start, end, ddir, results in intervals:
+        print("%s, %s" % (row_label(ctx, end, ddir), ', '.join(["%0.3f" % i for i in results])))
+
+def print_sums(ctx, intervals):
+    for start, end, ddir, results in intervals:
+        print("%s, %0.3f" % (row_label(ctx, end, ddir), sum(results)))
+
+def print_averages(ctx, intervals):
+    for start, end, ddir, results in intervals:
+        print("%s, %0.3f" % (row_label(ctx, end, ddir), float(sum(results))/len(results)))
+
+class RollingWindow(object):
+    """ Mean, standard deviation, min and max of the last n values added.
+
+        The window keeps running sums of the values and of their squares,
+        taken relative to the first value to limit cancellation, and two
+        monotonic deques of candidate minima and maxima.  Every value enters
+        and leaves each of them once, so adding a value costs O(1) amortized
+        however large the window is. """
+    def __init__(self, n):
+        self.n = n
+        self.values = collections.deque()
+        self.shift = None
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.mins = collections.deque()     # (index, value), values increasing
+        self.maxs = collections.deque()     # (index, value), values decreasing
+        self.count = 0
+
+    def add(self, value):
+        if self.shift is None:
+            self.shift = value
+        delta = value - self.shift
+        self.values.append(delta)
+        self.sum += delta
+        self.sumsq += delta * delta
+        if len(self.values) > self.n:
+            old = self.values.popleft()
+            self.sum -= old
+            self.sumsq -= old * old
+
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((self.count, value))
+        while self.maxs and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((self.count, value))
+        self.count += 1
+        oldest = self.count - self.n
+        while self.mins[0][0] < oldest:
+            self.mins.popleft()
+        while self.maxs[0][0] < oldest:
+            self.maxs.popleft()
+
+    def full(self):
+        return len(self.values) == self.n
+
+    def get_stats(self):
+        """ Return the mean, standard deviation, min and max of the window. """
+        n = len(self.values)
+        mean = self.sum / n
+        var = max(0.0, self.sumsq / n - mean * mean)
+        return self.shift + mean, math.sqrt(var), self.mins[0][1], self.maxs[0][1]
+
+def rolling_stats(ctx, intervals):
+    """ Yield the RollingStats of the per-interval sums over every full
+        window, at the end time of its last interval. """
+    steps = ctx.rolling // ctx.interval
+    windows = {}
+    for start, end, ddir, results in intervals:
+        if ddir not in windows:
+            windows[ddir] = RollingWindow(steps)
+        window = windows[ddir]
+        window.add(float(sum(results)))
+        if window.full():
+            yield RollingStats(*((end, ddir) + window.get_stats()))
+
+def print_rolling(ctx, intervals):
+    head = ['end-time, dir'] if ctx.directions else ['end-time']
+    print(', '.join(head + ['mean, stddev, min, max']))
+    for stats in rolling_stats(ctx, intervals):
+        print("%s, %0.3f, %0.3f, %0.3f, %0.3f" % ((row_label(ctx, stats.end, stats.dir),) + stats[2:]))
+
+# to debug print_all_stats, use
 #   # sort -n -t ',' -k 2 small.log
 # on your input.
 
-def my_extend( vlist, val ):
-    vlist.extend(val)
-    return vlist
+def interval_stats(ctx, intervals):
+    """ Yield the IntervalStats of every interval holding samples. """
+    percs = [0.5] + [float(p) / 100 for p in re.split('[,:]', ctx.percentiles)]
+    for start, end, ddir, samplevalues in intervals:
+        if len(samplevalues) == 0:
+            continue
+        if ctx.sketch:
+            mymin, myavg, mypercs, mymax = samplevalues.get_stats(percs)
+        else:
+            mymin, myavg, mypercs, mymax = get_stats(samplevalues, percs)
+        # as plain Python numbers, not NumPy scalars
+        yield IntervalStats(start, end, ddir, len(samplevalues), np.asarray(mymin).item(),
+                            float(myavg), float(mypercs[0]), [float(p) for p in mypercs[1:]],
+                            np.asarray(mymax).item())
 
-array_collapser = lambda vlist, val:  my_extend(vlist, val) 
+def print_all_stats(ctx, intervals):
+    strpercs = re.split('[,:]', ctx.percentiles)
+    head = ['start-time, dir'] if ctx.directions else ['start-time']
+    print(', '.join(head + ['samples, min, avg, median'] +
+                    [p + '%' for p in strpercs] + ['max']))
+    fmt = ('%f, %s, ' if ctx.directions else '%f, ') + '%d, ' + ', '.join(['%f'] * (len(strpercs) + 4))
+    for stats in interval_stats(ctx, intervals):
+        label = [stats.start, stats.dir] if ctx.directions else [stats.start]
+        print(fmt % tuple(label + [stats.samples, stats.min, stats.avg, stats.median] +
+                          list(stats.percentiles) + [stats.max]))
 
-def print_all_stats(ctx, series):
-    ftime = get_ftime(series)
-    start = 0 
-    end = ctx.interval
-    print('start-time, samples, min, avg, median, 90%, 95%, 99%, max')
-    while (start < ftime):  # for each time interval
-        end = ftime if ftime < end else end
-        sample_arrays = [ s.get_samples(start, end) for s in series ]
-        samplevalue_arrays = []
-        for sample_array in sample_arrays:
-            samplevalue_arrays.append( 
-                [ sample.value for sample in sample_array ] )
-        # collapse list of lists of sample values into list of sample values
-        samplevalues = reduce( array_collapser, samplevalue_arrays, [] )
-        # compute all stats and print them
-        mymin = min(samplevalues)
-        myavg = sum(samplevalues) / float(len(samplevalues))
-        mymedian = median(samplevalues)
-        my90th = percentile(samplevalues, 0.90) 
-        my95th = percentile(samplevalues, 0.95)
-        my99th = percentile(samplevalues, 0.99)
-        mymax = max(samplevalues)
-        print( '%f, %d, %f, %f, %f, %f, %f, %f, %f' % (
-            start, len(samplevalues), 
-            mymin, myavg, mymedian, my90th, my95th, my99th, mymax))
-
-        # advance to next interval
-        start += ctx.interval
-        end += ctx.interval
-
-def median(values):
-    s=sorted(values)
-    return float(s[(len(s)-1)/2]+s[(len(s)/2)])/2
-
-def percentile(values, p):
-    s = sorted(values)
-    k = (len(s)-1) * p
-    f = math.floor(k)
-    c = math.ceil(k)
-    if f == c:
-        return s[int(k)]
-    return (s[int(f)] * (c-k)) + (s[int(c)] * (k-f))
-
-def print_default(ctx, series):
-    ftime = get_ftime(series)
-    start = 0
-    end = ctx.interval
-    averages = []
-    weights = []
-
-    while (start < ftime):
-        end = ftime if ftime < end else end
-        results = [ts.get_value(start, end) for ts in series]
-        averages.append(sum(results)) 
-        weights.append(end-start)
-        start += ctx.interval
-        end += ctx.interval
+def get_stats(values, percs):
+    """ Return the min, average, percentiles and max of values, with
+        percs given as fractions.  Percentiles interpolate linearly
+        between the two nearest ranks.  All order statistics come from a
+        single partition of the values instead of a sort per statistic. """
+    values = np.asarray(values)
+    n = len(values)
+    ks = np.asarray(percs, dtype=float) * (n - 1)
+    lo = np.floor(ks).astype(int)
+    hi = np.ceil(ks).astype(int)
+    part = np.partition(values, np.unique(np.concatenate(([0, n - 1], lo, hi))))
+    pvals = np.where(lo == hi, part[lo], part[lo] * (hi - ks) + part[hi] * (ks - lo))
+    return part[0], float(values.sum()) / n, pvals, part[n - 1]
+
+class LogSketch(object):
+    """ Mergeable quantile sketch with a relative error guarantee.
+
+        Positive values are counted in logarithmically sized buckets,
+        bucket i holding the values in (gamma^(i-1), gamma^i] with
+        gamma = (1 + accuracy) / (1 - accuracy); values <= 0 share a
+        single zero bucket.  Reporting 2 * gamma^i / (gamma + 1) for a
+        value in bucket i is off by at most accuracy * value, and since
+        percentiles interpolate between two ranks, every percentile
+        estimate is within a relative error of accuracy of the exact
+        percentile.  Count, sum, min and max are kept exactly.
+
+        The summary holds one bucket per distinct power of gamma seen,
+        at most log(max / min) / log(gamma) + 1 buckets (about 1200 for
+        1% accuracy over 1 ns .. 10 s), however many values were added.
+        Sketches of the same accuracy merge by adding bucket counts, so
+        per-file and per-interval sketches combine without losing
+        accuracy. """
+    def __init__(self, accuracy):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.keys = np.empty(0, np.int64)
+        self.counts = np.empty(0, np.int64)
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def from_values(cls, accuracy, values):
+        sketch = cls(accuracy)
+        sketch.add(values)
+        return sketch
+
+    @classmethod
+    def merged(cls, sketches):
+        sketches = list(sketches)
+        result = cls(sketches[0].accuracy)
+        for sketch in sketches:
+            result.merge(sketch)
+        return result
+
+    def __len__(self):
+        return self.count
 
-    total = 0
-    for i in range(0, len(averages)):
-        total += averages[i]*weights[i]
-    print('%0.3f' % (total/sum(weights)))
+    def _combine(self, keys, counts):
+        keys, inverse = np.unique(np.concatenate((self.keys, keys)), return_inverse=True)
+        self.counts = np.bincount(inverse, weights=np.concatenate((self.counts, counts)),
+                                  minlength=len(keys)).astype(np.int64)
+        self.keys = keys
+
+    def _update(self, count, total, mn, mx):
+        self.count += count
+        self.sum += total
+        self.min = mn if self.min is None else min(self.min, mn)
+        self.max = mx if self.max is None else max(self.max, mx)
+
+    def add(self, values):
+        values = np.asarray(values)
+        if len(values) == 0:
+            return
+        positive = values[values > 0]
+        self.zeros += len(values) - len(positive)
+        keys = np.ceil(np.log(positive) / np.log(self.gamma)).astype(np.int64)
+        keys, counts = np.unique(keys, return_counts=True)
+        self._combine(keys, counts)
+        self._update(len(values), values.sum(), values.min(), values.max())
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if other.accuracy != self.accuracy:
+            raise ValueError('cannot merge sketches of different accuracy')
+        self._combine(other.keys, other.counts)
+        self.zeros += other.zeros
+        self._update(other.count, other.sum, other.min, other.max)
+
+    def _ranks(self, ranks):
+        """ Return the estimated values of the given (integer) ranks. """
+        cum = self.zeros + np.cumsum(self.counts)
+        idx = np.minimum(np.searchsorted(cum, ranks, side='right'), len(cum) - 1)
+        values = 2 * self.gamma ** self.keys[idx].astype(float) / (self.gamma + 1)
+        values = np.where(ranks < self.zeros, 0, values)
+        return np.clip(values, self.min, self.max)
+
+    def get_stats(self, percs):
+        """ Return the min, average, percentiles and max, like get_stats(). """
+        ks = np.asarray(percs, dtype=float) * (self.count - 1)
+        lo = np.floor(ks)
+        hi = np.ceil(ks)
+        vlo, vhi = self._ranks(lo), self._ranks(hi)
+        pvals = np.where(lo == hi, vlo, vlo * (hi - ks) + vhi * (ks - lo))
+        return self.min, float(self.sum) / self.count, pvals, self.max
+
+def print_default(ctx, intervals):
+    averages = collections.defaultdict(list)
+    weights = collections.defaultdict(list)
+
+    for start, end, ddir, results in intervals:
+        averages[ddir].append(sum(results)) 
+        weights[ddir].append(end-start)
+
+    for ddir in get_directions(ctx):
+        total = 0
+        for i in range(0, len(averages[ddir])):
+            total += averages[ddir][i]*weights[ddir][i]
+        if ctx.directions:
+            print('%s, %0.3f' % (ddir, total/sum(weights[ddir])))
+        else:
+            print('%0.3f' % (total/sum(weights[ddir])))
  
+class Columns(collections.namedtuple('Columns', 'start end value ddir bs offset')):
+    """ A block of samples stored column-wise in typed arrays. """
+    __slots__ = ()
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, np.int64), np.empty(0, np.int64),
+                   np.empty(0, np.int64), np.empty(0, np.int8),
+                   np.empty(0, np.int32), np.empty(0, np.int64))
+
+    @classmethod
+    def concatenate(cls, blocks):
+        blocks = list(blocks)
+        if not blocks:
+            return cls.empty()
+        return cls(*[np.concatenate(col) for col in zip(*blocks)])
+
+    def extend(self, block):
+        return Columns.concatenate((self, block))
+
+    def since(self, time):
+        """ Return the samples which have not ended before time. """
+        keep = self.end >= time
+        return Columns(*[col[keep] for col in self])
+
+    def direction(self, ddir, p_time=0):
+        """ Return the samples of direction ddir, all of them for 'm'.  As
+            in a log holding only that direction, each sample starts where
+            the previous one of the direction ended, the first at p_time. """
+        if ddir == 'm':
+            return self
+        keep = self.ddir == DIRECTIONS.index(ddir)
+        cols = Columns(*[col[keep] for col in self])
+        start = np.empty_like(cols.end)
+        if len(start):
+            start[0] = p_time
+            start[1:] = cols.end[:-1]
+        return cols._replace(start=start)
+
+def block_columns(vals, p_time):
+    """ Convert an integer matrix of log lines into Columns.  The offset
+        column is zero for logs written without log_offset. """
+    end = np.ascontiguousarray(vals[:, 0])
+    start = np.empty_like(end)
+    start[0] = p_time
+    start[1:] = end[:-1]
+    if vals.shape[1] > 4:
+        offset = np.ascontiguousarray(vals[:, 4])
+    else:
+        offset = np.zeros(len(vals), dtype=np.int64)
+    return Columns(start, end, np.ascontiguousarray(vals[:, 1]),
+                   vals[:, 2].astype(np.int8), vals[:, 3].astype(np.int32), offset)
+
+# Parsed logs are cached in a compact, memory-mappable file next to each
+# log (see tools/fiolog.py), so that re-analysing a log costs next to
+# nothing.
+
+def read_blocks(fn, cache=True):
+    """ Yield the samples of fn as blocks of Columns, from the cache of
+        fn when there is a valid one.  Otherwise the log is parsed, and
+        the cache is built along the way if cache is set. """
+    cached = load_cache(fn) if cache else None
+    if cached is not None:
+        blocks = cached.blocks()
+        writer = None
+    else:
+        blocks = parse_log(fn, ncols_allowed=(4, 5))
+        writer = CacheWriter(fn) if cache else None
+
+    p_time = 0
+    try:
+        for block in blocks:
+            if writer:
+                writer.append(block)
+            if len(block) == 0:
+                continue
+            columns = block_columns(block, p_time)
+            p_time = columns.end[-1]
+            yield columns
+        if writer:
+            writer.commit()
+    finally:
+        # only a cache of the whole log is kept
+        if writer:
+            writer.abort()
+
 class TimeSeries(object):
-    def __init__(self, ctx, fn):
+    """ The samples of one log file, stored column-wise in contiguous
+        typed arrays rather than as one object per line.  Each sample
+        covers [start, end], where start is the time of the previous
+        line in the file. """
+    def __init__(self, ctx, fn, columns=None):
         self.ctx = ctx
-        self.last = None 
-        self.samples = []
-        self.read_data(fn)
+        if columns is None:
+            self.read_data(fn)
+        else:
+            self.set_columns(columns)
 
     def read_data(self, fn):
-        f = open(fn, 'r')
-        p_time = 0
-        for line in f:
-            (time, value, foo, bar) = line.rstrip('\r\n').rsplit(', ')
-            self.add_sample(p_time, int(time), int(value))
-            p_time = int(time)
- 
-    def add_sample(self, start, end, value):
-        sample = Sample(ctx, start, end, value)
-        if not self.last or self.last.end < end:
-            self.last = sample
-        self.samples.append(sample)
+        self.set_columns(Columns.concatenate(read_blocks(fn, getattr(self.ctx, 'cache', True))))
+
+    def set_columns(self, cols):
+        self.start, self.end, self.value, self.ddir, self.bs, self.offset = cols
+        self.last_end = int(self.end.max()) if len(self.end) else 0
+        # range queries below need the samples ordered by start time,
+        # which is normally already the case
+        if np.any(self.start[1:] < self.start[:-1]):
+            order = np.argsort(self.start, kind='mergesort')
+            for col in Columns._fields:
+                setattr(self, col, getattr(self, col)[order])
+        self.max_len = int((self.end - self.start).max()) if len(self.end) else 0
+
+    def _overlapping(self, start, end):
+        """ Return the slice of samples which may overlap [start, end]. """
+        lo = np.searchsorted(self.start, start - self.max_len, side='left')
+        hi = np.searchsorted(self.start, end, side='right')
+        return slice(lo, hi)
 
     def get_samples(self, start, end):
-        sample_list = []
-        for s in self.samples:
-            if s.start >= start and s.end <= end:
-                sample_list.append(s)
-        return sample_list
+        """ Return the values of the samples lying within [start, end]. """
+        sl = self._overlapping(start, end)
+        s, e = self.start[sl], self.end[sl]
+        return self.value[sl][(s >= start) & (e <= end)]
 
     def get_value(self, start, end):
-        value = 0
-        for sample in self.samples:
-            value += sample.get_contribution(start, end)
-        return value
+        """ Return the pro rata value of the samples over [start, end]. """
+        sl = self._overlapping(start, end)
+        overlap = (np.minimum(self.end[sl], end) -
+                   np.maximum(self.start[sl], start)).clip(0)
+        return float(np.dot(self.value[sl], overlap)) / (end - start) / self.ctx.divisor
+
+def read_series(ctx, fn, directions):
+    """ Read fn once and return a dict of its TimeSeries for each of
+        directions. """
+    cols = Columns.concatenate(read_blocks(fn, getattr(ctx, 'cache', True)))
+    return dict((ddir, TimeSeries(ctx, fn, cols.direction(ddir))) for ddir in directions)
+
+def log_intervals(ctx, samples=False):
+    """ Yield (start, end, dir, results) for each interval and direction
+        of the logs ctx.FILE, using the engine selected by ctx.  results
+        holds the value of every log over the interval or, with samples
+        set, the samples of all logs within it. """
+    if ctx.stream:
+        engine = stream_samples if samples else stream_values
+        intervals = engine(ctx, ctx.FILE)
+    elif ctx.jobs > 1:
+        engine = pool_samples if samples else pool_values
+        intervals = engine(ctx, ctx.FILE)
+    else:
+        engine = interval_samples if samples else interval_values
+        directions = get_directions(ctx)
+        tables = [read_series(ctx, fn, directions) for fn in ctx.FILE]
+        intervals = engine(ctx, dict((ddir, [table[ddir] for table in tables])
+                                     for ddir in directions))
+    for row in intervals:
+        yield row
+
+# Library interface.
+#
+# Besides being run as a command, this file can be imported (with tools/
+# on sys.path) to get the interval statistics as Python objects rather
+# than as CSV text:
+#
+#     from fiologparser import LogReader
+#     for rec in LogReader(['job_bw.1.log', 'job_bw.2.log'], interval=500).sums():
+#         print(rec.end, rec.value)
+#
+# Records are namedtuples which are computed while the logs are read, so
+# a caller may stop at any point; closing the generator releases the
+# logs.  Numbers are the same as printed by the command, unformatted.
+
+Interval = collections.namedtuple('Interval', 'start end dir values')
+IntervalValue = collections.namedtuple('IntervalValue', 'start end dir value')
+IntervalStats = collections.namedtuple('IntervalStats', 'start end dir samples min avg median percentiles max')
+RollingStats = collections.namedtuple('RollingStats', 'end dir mean stddev min max')
+
+def get_context(files, **options):
+    """ Return the context for reading files, holding the defaults of
+        the command line options except for the given options, which are
+        named after the attributes parse_args() sets. """
+    ctx = build_parser().parse_args(['--'] + list(files))
+    for name, value in options.items():
+        if name == 'FILE' or not hasattr(ctx, name):
+            raise TypeError('unknown option %r' % name)
+        setattr(ctx, name, value)
+    if not isinstance(ctx.percentiles, str):
+        ctx.percentiles = ':'.join([str(p) for p in ctx.percentiles])
+    check_args(ctx)
+    return ctx
+
+class LogReader(object):
+    """ Interval statistics of one or more fio logs.  The keyword options
+        are those of the command line: interval, divisor, directions,
+        percentiles (a list or a string), sketch, sketch_accuracy, stream,
+        jobs and cache.
+        Each method returns a generator of records, iterating a reader
+        yields its values(). """
+    def __init__(self, files, **options):
+        if isinstance(files, str):
+            files = [files]
+        self.ctx = get_context(files, **options)
+
+    def __iter__(self):
+        return self.values()
+
+    def values(self):
+        """ Yield an Interval holding the array of the values of every log
+            over each interval, as printed by --full. """
+        for start, end, ddir, results in log_intervals(self.ctx):
+            yield Interval(start, end, ddir, np.asarray(results))
+
+    def sums(self):
+        """ Yield an IntervalValue with the sum over the logs, as --sum. """
+        for start, end, ddir, results in log_intervals(self.ctx):
+            yield IntervalValue(start, end, ddir, float(sum(results)))
+
+    def averages(self):
+        """ Yield an IntervalValue with the average of the logs, as --average. """
+        for start, end, ddir, results in log_intervals(self.ctx):
+            yield IntervalValue(start, end, ddir, float(sum(results)) / len(results))
+
+    def samples(self):
+        """ Yield an Interval holding the array of the values of all samples
+            within each interval, or their LogSketch with the sketch option. """
+        for start, end, ddir, values in log_intervals(self.ctx, samples=True):
+            yield Interval(start, end, ddir, values)
+
+    def stats(self):
+        """ Yield the IntervalStats of each interval, as --all. """
+        return interval_stats(self.ctx, log_intervals(self.ctx, samples=True))
+
+    def rolling(self, window):
+        """ Yield the RollingStats over a window sliding by one interval,
+            as --rolling. """
+        ctx = argparse.Namespace(**vars(self.ctx))
+        ctx.rolling = window
+        check_args(ctx)
+        return rolling_stats(ctx, log_intervals(ctx))
+
+##### below are unit tests ##############
+
+if unittest2_imported:
+    import shutil
+    import subprocess
+    import tempfile
+
+    class Test(unittest2.TestCase):
+        tempdir = None
+
+        @classmethod
+        def setUpClass(cls):
+            cls.tempdir = tempfile.mkdtemp()
+
+        @classmethod
+        def tearDownClass(cls):
+            shutil.rmtree(cls.tempdir)
 
-class Sample(object):
-    def __init__(self, ctx, start, end, value):
-       self.ctx = ctx
-       self.start = start
-       self.end = end
-       self.value = value
+        def write_logs(self, count):
+            files = []
+            for i in range(count):
+                fn = os.path.join(self.tempdir, '%s.%d.log' % (self.id(), i))
+                with open(fn, 'w') as f:
+                    for t in range(100, 5000, 100):
+                        f.write('%d, %d, 0, 4096\n' % (t, 1000 + (t * (i + 7)) % 997))
+                files.append(fn)
+            return files
 
-    def get_contribution(self, start, end):
-       # short circuit if not within the bound
-       if (end < self.start or start > self.end):
-           return 0 
+        def run_cli(self, args):
+            env = dict(os.environ)
+            env.pop('UNITTEST', None)
+            return subprocess.check_output([sys.executable, os.path.abspath(__file__)] + args,
+                                           env=env, universal_newlines=True)
 
-       sbound = self.start if start < self.start else start
-       ebound = self.end if end > self.end else end
-       ratio = float(ebound-sbound) / (end-start) 
-       return self.value*ratio/ctx.divisor
+        # --sketch takes no value, so the files may follow it directly
+        def test_sketch_before_files(self):
+            files = self.write_logs(2)
+            args = build_parser().parse_args(['-A', '--sketch'] + files)
+            self.assertTrue(args.sketch)
+            self.assertEqual(args.sketch_accuracy, 0.01)
+            self.assertEqual(args.FILE, files)
+            sketched = self.run_cli(['-A', '--sketch', '--no-cache'] + files).splitlines()
+            exact = self.run_cli(['-A', '--no-cache'] + files).splitlines()
+            self.assertEqual(len(sketched), len(exact))
+            self.assertEqual([l.split(',')[:3] for l in sketched], [l.split(',')[:3] for l in exact])
 
+        def test_sketch_accuracy(self):
+            files = self.write_logs(1)
+            args = build_parser().parse_args(['-A', '--sketch-accuracy', '0.05', '--sketch'] + files)
+            self.assertEqual((args.sketch, args.sketch_accuracy, args.FILE), (True, 0.05, files))
+            self.assertFalse(build_parser().parse_args(['--exact'] + files).sketch)
+            for rec in LogReader(files, sketch=True, sketch_accuracy=0.05, cache=False).samples():
+                self.assertEqual(rec.values.accuracy, 0.05)
+            self.assertRaises(ValueError, get_context, files, sketch_accuracy=1.0)
 
 if __name__ == '__main__':
+    if os.getenv('UNITTEST'):
+        if unittest2_imported:
+            sys.exit(unittest2.main())
+        else:
+            raise Exception('you must install unittest2 module to run unit test')
     ctx = parse_args()
-    series = []
-    for fn in ctx.FILE:
-       series.append(TimeSeries(ctx, fn)) 
-    if ctx.sum:
-        print_sums(ctx, series)
+    if ctx.rolling:
+        print_rolling(ctx, log_intervals(ctx))
+    elif ctx.sum:
+        print_sums(ctx, log_intervals(ctx))
     elif ctx.average:
-        print_averages(ctx, series)
+        print_averages(ctx, log_intervals(ctx))
     elif ctx.full:
-        print_full(ctx, series)
+        print_full(ctx, log_intervals(ctx))
     elif ctx.allstats:
-        print_all_stats(ctx, series)
+        print_all_stats(ctx, log_intervals(ctx, samples=True))
     else:
-        print_default(ctx, series)
+        print_default(ctx, log_intervals(ctx))
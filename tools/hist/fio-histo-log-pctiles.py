@@ -21,9 +21,10 @@
 # if you do this, don't pass normal CLI parameters to it
 # otherwise it runs the CLI
 
-import sys, os, math, copy, time
+import sys, os, math, copy, time, warnings
 from copy import deepcopy
 import argparse
+from functools import reduce
 
 unittest2_imported = True
 try:
@@ -31,11 +32,32 @@ try:
 except ImportError:
     unittest2_imported = False
 
+# with numpy, histogram logs are read and aligned to time quanta as arrays
+# (see read_hist_blocks and align_hist_blocks), and the bucket time ranges
+# are taken from the vectorized tables of fiolog.py, in tools/
+try:
+    import numpy as np
+except ImportError:
+    np = None
+bin_table = None
+if np:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    try:
+        from fiolog import bin_table
+    except ImportError:
+        pass
+
 msec_per_sec = 1000
 nsec_per_usec = 1000
 direction_read = 0
 direction_write = 1
 
+# latency histograms are mostly empty buckets, so with --sparse a histogram
+# is kept as a dictionary of its nonzero buckets indexed by bucket number,
+# until more than this fraction of its buckets are used and it is made
+# into a list again
+sparse_density_max = 0.25
+
 class FioHistoLogExc(Exception):
     pass
 
@@ -57,85 +79,267 @@ def myabort(msg):
 def exception_suffix( record_num, pathname ):
     return 'in histogram record %d file %s' % (record_num+1, pathname)
 
+# return the (bucket index, count) pairs of a histogram in bucket order,
+# for a list of all buckets or a dictionary of the nonzero ones
+
+def histo_items(buckets):
+    if isinstance(buckets, dict):
+        return sorted(buckets.items())
+    return enumerate(buckets)
+
+# return the histogram as a dictionary of its nonzero buckets,
+# or as a list if too many of its bucket_count buckets are used
+
+def sparsify(buckets, bucket_count):
+    if isinstance(buckets, dict):
+        nonzero = buckets
+    else:
+        nonzero = dict([ (bx, b) for bx, b in enumerate(buckets) if b != 0 ])
+    if len(nonzero) <= sparse_density_max * bucket_count:
+        return nonzero
+    dense = [ 0.0 for bx in range(0, bucket_count) ] if buckets is nonzero else buckets
+    for bx, b in nonzero.items():
+        dense[bx] = b
+    return dense
+
 # log file parser raises FioHistoLogExc exceptions
 # it returns histogram buckets in whatever unit fio uses
 # inputs:
 #  logfn: pathname to histogram log file
 #  buckets_per_interval - how many histogram buckets to expect
 #  log_hist_msec - if not None, expected time interval between histogram records
+#  sparse - if True, buckets of sparse records are returned as dictionaries
+# the records are read with read_hist_blocks if numpy is available,
+# otherwise a line at a time with read_hist_lines
 
-def parse_hist_file(logfn, buckets_per_interval, log_hist_msec):
-    previous_ts_ms_read = -1
-    previous_ts_ms_write = -1
- 
-    with open(logfn, 'r') as f:
-        records = [ l.strip() for l in f.readlines() ]
+def parse_hist_file(logfn, buckets_per_interval, log_hist_msec, sparse=False):
+    if np:
+        records = block_records(read_hist_blocks(logfn, buckets_per_interval))
+    else:
+        records = read_hist_lines(logfn, buckets_per_interval)
     intervals = []
-    last_time_ms = -1
-    last_direction = -1
-    for k, r in enumerate(records):
-        if r == '':
-            continue
-        tokens = r.split(',')
-        try:
-            int_tokens = [ int(t) for t in tokens ]
-        except ValueError as e:
-            raise FioHistoLogExc('non-integer value %s' % exception_suffix(k+1, logfn))
-
-        neg_ints = list(filter( lambda tk : tk < 0, int_tokens ))
-        if len(neg_ints) > 0:
-            raise FioHistoLogExc('negative integer value %s' % exception_suffix(k+1, logfn))
-
-        if len(int_tokens) < 3:
-            raise FioHistoLogExc('too few numbers %s' % exception_suffix(k+1, logfn))
-
-        direction = int_tokens[1]
-        if direction != direction_read and direction != direction_write:
-            raise FioHistoLogExc('invalid I/O direction %s' % exception_suffix(k+1, logfn))
-
-        time_ms = int_tokens[0]
-        if direction == direction_read:
-            if time_ms < previous_ts_ms_read:
-                raise FioHistoLogExc('read timestamp in column 1 decreased %s' % exception_suffix(k+1, logfn))
-            previous_ts_ms_read = time_ms
-        elif direction == direction_write:
-            if time_ms < previous_ts_ms_write:
-                raise FioHistoLogExc('write timestamp in column 1 decreased %s' % exception_suffix(k+1, logfn))
-            previous_ts_ms_write = time_ms
-
-        bsz = int_tokens[2]
-        if bsz > (1 << 24):
-            raise FioHistoLogExc('block size too large %s' % exception_suffix(k+1, logfn))
-
-        buckets = int_tokens[3:]
-        if len(buckets) != buckets_per_interval:
-            raise FioHistoLogExc('%d buckets per interval but %d expected in %s' % 
-                    (len(buckets), buckets_per_interval, exception_suffix(k+1, logfn)))
-
-        # hack to filter out records with the same timestamp
-        # we should not have to do this if fio logs histogram records correctly
-
-        if time_ms == last_time_ms and direction == last_direction:
-            continue
-        last_time_ms = time_ms
-        last_direction = direction
-
+    for (time_ms, direction, bsz, buckets) in records:
+        if sparse:
+            buckets = sparsify(buckets, buckets_per_interval)
         intervals.append((time_ms, direction, bsz, buckets))
     if len(intervals) == 0:
         raise FioHistoLogExc('no records in %s' % logfn)
-    (first_timestamp, _, _, _) = intervals[0]
+    start_time = estimate_start_time([ t for (t, _, _, _) in intervals[:2] ], log_hist_msec)
+    (end_timestamp, _, _, _) = intervals[-1]
+
+    return (intervals, start_time, end_timestamp)
+
+# estimate the test start time from the first (one or two) timestamps of a log
+
+def estimate_start_time(first_timestamps, log_hist_msec):
+    first_timestamp = first_timestamps[0]
     if first_timestamp < 1000000:
         start_time = 0    # assume log_unix_epoch = 0
     elif log_hist_msec != None:
         start_time = first_timestamp - log_hist_msec
-    elif len(intervals) > 1:
-        (second_timestamp, _, _, _) = intervals[1]
+    elif len(first_timestamps) > 1:
+        second_timestamp = first_timestamps[1]
         start_time = first_timestamp - (second_timestamp - first_timestamp)
     else:
         raise FioHistoLogExc('no way to estimate test start time')
-    (end_timestamp, _, _, _) = intervals[-1]
-
-    return (intervals, start_time, end_timestamp)
+    return start_time
+
+# check the k-th line of a histogram log, stripped, and return its numbers
+# previous_ts holds the last read and write timestamps, and is updated
+
+def check_hist_line(line, k, logfn, buckets_per_interval, previous_ts):
+    tokens = line.split(b',')
+    try:
+        int_tokens = [ int(t) for t in tokens ]
+    except ValueError as e:
+        raise FioHistoLogExc('non-integer value %s' % exception_suffix(k+1, logfn))
+
+    if min(int_tokens) < 0:
+        raise FioHistoLogExc('negative integer value %s' % exception_suffix(k+1, logfn))
+
+    if len(int_tokens) < 3:
+        raise FioHistoLogExc('too few numbers %s' % exception_suffix(k+1, logfn))
+
+    direction = int_tokens[1]
+    if direction != direction_read and direction != direction_write:
+        raise FioHistoLogExc('invalid I/O direction %s' % exception_suffix(k+1, logfn))
+
+    time_ms = int_tokens[0]
+    if direction == direction_read:
+        if time_ms < previous_ts[direction_read]:
+            raise FioHistoLogExc('read timestamp in column 1 decreased %s' % exception_suffix(k+1, logfn))
+    elif direction == direction_write:
+        if time_ms < previous_ts[direction_write]:
+            raise FioHistoLogExc('write timestamp in column 1 decreased %s' % exception_suffix(k+1, logfn))
+    previous_ts[direction] = time_ms
+
+    bsz = int_tokens[2]
+    if bsz > (1 << 24):
+        raise FioHistoLogExc('block size too large %s' % exception_suffix(k+1, logfn))
+
+    buckets = int_tokens[3:]
+    if len(buckets) != buckets_per_interval:
+        raise FioHistoLogExc('%d buckets per interval but %d expected in %s' % 
+                (len(buckets), buckets_per_interval, exception_suffix(k+1, logfn)))
+    return int_tokens
+
+# yield the (time_ms, direction, bsz, buckets) records of a histogram log,
+# reading and checking it a line at a time
+
+def read_hist_lines(logfn, buckets_per_interval):
+    previous_ts = [ -1, -1 ]
+    last_record = (-1, -1)
+    with open(logfn, 'rb') as f:
+        for k, line in enumerate(f):
+            line = line.strip()
+            if line == b'':
+                continue
+            int_tokens = check_hist_line(line, k, logfn, buckets_per_interval, previous_ts)
+            (time_ms, direction, bsz) = int_tokens[:3]
+
+            # hack to filter out records with the same timestamp
+            # we should not have to do this if fio logs histogram records correctly
+
+            if (time_ms, direction) == last_record:
+                continue
+            last_record = (time_ms, direction)
+            yield (time_ms, direction, bsz, int_tokens[3:])
+
+# bytes of log text read and decoded at a time by read_hist_blocks
+
+hist_block_bytes = 1 << 22
+
+# yield the records of a histogram log as blocks of arrays
+# (times, directions, bszs, buckets), where buckets is a
+# (records x buckets_per_interval) array, so that only one block of the
+# log is held at a time.  all numbers of a block are decoded by one
+# np.fromstring call, and checked by array-wide comparisons which raise
+# the same errors, for the same record, as check_hist_line does.  if the
+# block does not decode as expected, it is checked line by line instead to
+# find the bad record.  like read_hist_lines, records repeating the
+# timestamp and direction of the previous one are dropped
+
+def read_hist_blocks(logfn, buckets_per_interval):
+    previous_ts = [ -1, -1 ]
+    last_record = (-1, -1)
+    first_line = 0      # line number of the first line of the block
+    rest = b''
+    with open(logfn, 'rb') as f:
+        eof = False
+        while not eof:
+            data = f.read(hist_block_bytes)
+            eof = (data == b'')
+            data = rest + data
+            cut = len(data) if eof else data.rfind(b'\n') + 1
+            (data, rest) = (data[:cut], data[cut:])
+            lines = data.split(b'\n')
+            if data.endswith(b'\n') or data == b'':
+                lines.pop()
+            line_nums = [ k for k, line in enumerate(lines) if line.strip() != b'' ]
+            records = [ lines[k].strip() for k in line_nums ]
+            line_nums = np.array(line_nums, dtype=np.int64) + first_line
+            first_line += len(lines)
+            if len(records) == 0:
+                continue
+
+            vals = decode_hist_block(records, buckets_per_interval + 3)
+            if vals is None:
+                ts = list(previous_ts)
+                vals = np.array([ check_hist_line(line, k, logfn, buckets_per_interval, ts)
+                                  for line, k in zip(records, line_nums) ], dtype=np.int64)
+            check_hist_block(vals, line_nums, logfn, previous_ts)
+
+            # hack to filter out records with the same timestamp, as above
+            (times, directions) = (vals[:, 0], vals[:, 1])
+            keep = ((times != np.r_[last_record[0], times[:-1]]) |
+                    (directions != np.r_[last_record[1], directions[:-1]]))
+            last_record = (times[-1], directions[-1])
+            vals = vals[keep]
+            yield (vals[:, 0], vals[:, 1], vals[:, 2], vals[:, 3:])
+
+# return the numbers of the given log lines as a (lines x columns) integer
+# array, or None unless each line is exactly columns integers
+
+def decode_hist_block(records, columns):
+    for line in records:
+        if line.count(b',') + 1 != columns:
+            return None
+    try:
+        with warnings.catch_warnings():
+            # numpy only warns about text it cannot decode
+            warnings.simplefilter('error')
+            vals = np.fromstring(b','.join(records), dtype=np.int64, sep=',')
+    except (ValueError, DeprecationWarning):
+        return None
+    if len(vals) != len(records) * columns:
+        return None
+    return vals.reshape(len(records), columns)
+
+# check the decoded records of a block, on log lines line_nums,
+# and raise the error of the first bad record
+# previous_ts holds the last read and write timestamps, and is updated
+
+def check_hist_block(vals, line_nums, logfn, previous_ts):
+    (times, directions, bszs) = (vals[:, 0], vals[:, 1], vals[:, 2])
+    # the checks of check_hist_line, in the same order
+    checks = [ ((vals < 0).any(axis=1), 'negative integer value %s'),
+               ((directions != direction_read) & (directions != direction_write),
+                'invalid I/O direction %s') ]
+    for (direction, name) in [ (direction_read, 'read'), (direction_write, 'write') ]:
+        same = np.flatnonzero(directions == direction)
+        decreased = np.zeros(len(vals), dtype=bool)
+        decreased[same] = times[same] < np.r_[previous_ts[direction], times[same[:-1]]]
+        checks.append((decreased, name + ' timestamp in column 1 decreased %s'))
+        if len(same) > 0:
+            previous_ts[direction] = int(times[same[-1]])
+    checks.append((bszs > (1 << 24), 'block size too large %s'))
+    failures = [ (np.argmax(bad), c) for c, (bad, _) in enumerate(checks) if bad.any() ]
+    if failures:
+        (k, c) = min(failures)
+        raise FioHistoLogExc(checks[c][1] % exception_suffix(line_nums[k]+1, logfn))
+
+# yield the records of read_hist_blocks one at a time,
+# as (time_ms, direction, bsz, buckets) tuples of ints and a list of ints
+
+def block_records(blocks):
+    for (times, directions, bszs, buckets) in blocks:
+        for record in zip(times.tolist(), directions.tolist(), bszs.tolist(), buckets.tolist()):
+            yield record
+
+# return the estimated test start time and the last timestamp of a log,
+# as parse_hist_file does, but reading only its first block and last line
+
+def hist_file_time_range(logfn, buckets_per_interval, log_hist_msec):
+    first_timestamps = []
+    blocks = read_hist_blocks(logfn, buckets_per_interval)
+    for (times, _, _, _) in blocks:
+        first_timestamps.extend(times[:2 - len(first_timestamps)].tolist())
+        if len(first_timestamps) == 2:
+            break
+    blocks.close()
+    if len(first_timestamps) == 0:
+        raise FioHistoLogExc('no records in %s' % logfn)
+    start_time = estimate_start_time(first_timestamps, log_hist_msec)
+
+    with open(logfn, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = b''
+        while pos > 0:
+            n = min(pos, 1 << 16)
+            pos -= n
+            f.seek(pos)
+            tail = f.read(n) + tail
+            lines = tail.strip().split(b'\n')
+            if len(lines) > 1 or pos == 0:
+                break
+    try:
+        end_timestamp = int(lines[-1].split(b',')[0])
+    except ValueError:
+        # read it all to report the bad record
+        for (times, _, _, _) in read_hist_blocks(logfn, buckets_per_interval):
+            end_timestamp = int(times[-1])
+    return (start_time, end_timestamp)
 
 
 # compute time range for each bucket index in histogram record
@@ -145,6 +349,11 @@ def parse_hist_file(logfn, buckets_per_interval, log_hist_msec):
 # but we convert fio v3 nanosecs to floating-point microseconds
 
 def time_ranges(groups, counters_per_group, fio_version=3):
+    bits = counters_per_group.bit_length() - 1
+    if bin_table and counters_per_group == 1 << bits:
+        unit = nsec_per_usec if fio_version == 3 else 1
+        lower_edges = bin_table(groups, bits, 0, float(unit))[0]
+        return [ [rmin, rmax] for rmin, rmax in zip(lower_edges[:-1].tolist(), lower_edges[1:].tolist()) ]
     bucket_width = 1
     bucket_base = 0
     bucket_intervals = []
@@ -187,8 +396,10 @@ def get_time_intervals(time_quantum, min_timestamp_ms, max_timestamp_ms):
 # (2000 - 1010) / (2000 - 1000) = 0.99
 # so the contribution of this bucket to this time quantum is
 # 515 x 0.99 = 509.85
+# with sparse, the aligned histograms start out as empty dictionaries
 
-def align_histo_log(raw_histogram_log, time_quantum, bucket_count, min_timestamp_ms, max_timestamp_ms):
+def align_histo_log(raw_histogram_log, time_quantum, bucket_count, min_timestamp_ms, max_timestamp_ms,
+                    sparse=False):
 
     # slice up test time int intervals of time_quantum seconds
 
@@ -199,7 +410,7 @@ def align_histo_log(raw_histogram_log, time_quantum, bucket_count, min_timestamp
     for j in range(0, time_interval_count):
         aligned_intervals.append((
             min_timestamp_ms + (j * time_qtm_ms),
-            [ 0.0 for j in range(0, bucket_count) ] ))
+            {} if sparse else [ 0.0 for j in range(0, bucket_count) ] ))
 
     log_record_count = len(raw_histogram_log)
     for k, record in enumerate(raw_histogram_log):
@@ -245,6 +456,14 @@ def align_histo_log(raw_histogram_log, time_quantum, bucket_count, min_timestamp
             if len(aligned_intervals) <= qtm_index:
                 break
 
+            # or start before others, skip quanta before the test start
+
+            if qtm_index < 0:
+                qtm_start_ms += time_qtm_ms
+                qtm_end_ms += time_qtm_ms
+                qtm_index += 1
+                continue
+
             # calculate fraction of time that this quantum 
             # overlaps histogram record's time interval
             
@@ -252,10 +471,16 @@ def align_histo_log(raw_histogram_log, time_quantum, bucket_count, min_timestamp
             overlap_end = min(qtm_end_ms, time_msec_end)
             weight = float(overlap_end - overlap_start)
             weight /= (time_msec_end - time_msec)
-            (_,aligned_histogram) = aligned_intervals[qtm_index]
-            for bx, b in enumerate(interval_buckets):
-                weighted_bucket = weight * b
-                aligned_histogram[bx] += weighted_bucket
+            (qtm_time_ms, aligned_histogram) = aligned_intervals[qtm_index]
+            if isinstance(aligned_histogram, dict):
+                for bx, b in histo_items(interval_buckets):
+                    aligned_histogram[bx] = aligned_histogram.get(bx, 0.0) + weight * b
+                aligned_histogram = sparsify(aligned_histogram, bucket_count)
+                aligned_intervals[qtm_index] = (qtm_time_ms, aligned_histogram)
+            else:
+                for bx, b in histo_items(interval_buckets):
+                    weighted_bucket = weight * b
+                    aligned_histogram[bx] += weighted_bucket
 
             # advance to the next time quantum
 
@@ -265,17 +490,154 @@ def align_histo_log(raw_histogram_log, time_quantum, bucket_count, min_timestamp
 
     return aligned_intervals
 
+# array engine for align_histo_log, used when numpy is available
+# the records of a log make up a (records x buckets) matrix, and
+# the overlap weights of every record with every time quantum
+# a sparse (quanta x records) matrix, in which a record only has entries
+# for the few quanta it overlaps.  the aligned histograms are the
+# (quanta x buckets) product of the two, and as the records are mostly
+# empty buckets too, it is computed from the nonzero buckets only:
+# every (quantum, record, weight) entry times every nonzero bucket of
+# its record is one weighted count, and np.bincount adds those up into
+# their (quantum, bucket) cells.  it adds them in record order, so the
+# results are exactly those of align_histo_log.
+# the records are aligned a block at a time, as read by read_hist_blocks,
+# holding back only the last few records of a block whose end times
+# depend on the records of the next one.
+
+# return the concatenation of range(start, start + count) for every start and count
+
+def expand_ranges(starts, counts):
+    ends = np.cumsum(counts)
+    total = int(ends[-1]) if len(ends) > 0 else 0
+    return np.arange(total) + np.repeat(starts - (ends - counts), counts)
+
+# how many records after a record the next one with the same direction may be:
+# for fio randrw workload, we have read and write records on same time interval,
+# sometimes in opposite order, so they can be separated by at most 2 other records
+
+end_lookahead = 3
+
+# end time of each record is the time of the next record with the same direction,
+# or end_time_ms if there is none in the rest of the records
+
+def record_end_times(times, directions, end_time_ms):
+    record_count = len(times)
+    ends = np.full(record_count, end_time_ms, dtype=np.int64)
+    found = np.zeros(record_count, dtype=bool)
+    for j in range(1, end_lookahead + 1):
+        n = max(record_count - j, 0)
+        same = ~found[:n] & (directions[j:] == directions[:n])
+        ends[:n][same] = times[j:][same]
+        found[:n] |= same
+    missing = np.flatnonzero(~found[:max(record_count - end_lookahead, 0)])
+    if len(missing) > 0:
+        raise FioHistoLogExc('no record with the same I/O direction within %d records after the one at %d ms' %
+                (end_lookahead, times[missing[0]]))
+    return ends
+
+# return the quantum index, record index and weight of every entry of
+# the overlap weight matrix, in record order
+
+def overlap_weights(times, ends, min_timestamp_ms, time_qtm_ms, time_interval_count):
+    # first quantum that overlaps each record, and the one after the last
+    first_qtm = np.maximum((times - min_timestamp_ms) // time_qtm_ms, 0)
+    end_qtm = np.minimum(-((min_timestamp_ms - ends) // time_qtm_ms), time_interval_count)
+    # (align_histo_log cannot weight zero-length records either)
+    qtm_counts = np.where(ends != times, np.maximum(end_qtm - first_qtm, 0), 0)
+    recs = np.repeat(np.arange(len(times)), qtm_counts)
+    qtms = expand_ranges(first_qtm, qtm_counts)
+    qtm_start_ms = min_timestamp_ms + qtms * time_qtm_ms
+    overlap = (np.minimum(qtm_start_ms + time_qtm_ms, ends[recs]) -
+               np.maximum(qtm_start_ms, times[recs]))
+    return qtms, recs, overlap.astype(float) / (ends - times)[recs]
+
+# takes the same inputs as align_histo_log, and returns the aligned
+# histograms as a (time intervals x buckets) array, in which row j is
+# the histogram of the quantum starting at min_timestamp_ms + j * time quantum
+
+def align_histo_array(raw_histogram_log, time_quantum, bucket_count, min_timestamp_ms, max_timestamp_ms):
+    record_count = len(raw_histogram_log)
+    times = np.array([ r[0] for r in raw_histogram_log ], dtype=np.int64)
+    directions = np.array([ r[1] for r in raw_histogram_log ], dtype=np.int64)
+    counts = np.zeros((record_count, bucket_count))
+    for k, (_, _, _, buckets) in enumerate(raw_histogram_log):
+        if isinstance(buckets, dict):
+            counts[k, list(buckets.keys())] = list(buckets.values())
+        else:
+            counts[k] = buckets
+    return align_hist_blocks([ (times, directions, None, counts) ], time_quantum, bucket_count,
+                             min_timestamp_ms, max_timestamp_ms)
+
+# same as align_histo_array, but takes the records of a log as blocks of
+# arrays from read_hist_blocks
+
+def align_hist_blocks(blocks, time_quantum, bucket_count, min_timestamp_ms, max_timestamp_ms):
+    (end_time, time_interval_count) = get_time_intervals(time_quantum, min_timestamp_ms, max_timestamp_ms)
+    time_qtm_ms = time_quantum * msec_per_sec
+    end_time_ms = end_time * msec_per_sec
+    aligned = np.zeros(time_interval_count * bucket_count)
+
+    # align the first done records, and return the others
+    def align_records(records, done):
+        (times, directions, _, counts) = records
+        ends = record_end_times(times, directions, end_time_ms)[:done]
+        (times, counts) = (times[:done], counts[:done])
+
+        # nonzero buckets of the records, in record order
+        nonzero = np.flatnonzero(counts)
+        (nz_recs, nz_buckets) = np.divmod(nonzero, bucket_count)
+        nz_counts = counts.ravel()[nonzero]
+        rec_nonzeros = np.bincount(nz_recs, minlength=done)
+        rec_starts = np.cumsum(rec_nonzeros) - rec_nonzeros
+
+        (qtms, recs, weights) = overlap_weights(times, ends, min_timestamp_ms, time_qtm_ms,
+                                                time_interval_count)
+        if len(qtms) > 0:
+            entries = np.repeat(np.arange(len(recs)), rec_nonzeros[recs])
+            picks = expand_ranges(rec_starts[recs], rec_nonzeros[recs])
+            # the counts of earlier blocks come first in the sums of their cells
+            (lo, hi) = (qtms.min() * bucket_count, (qtms.max() + 1) * bucket_count)
+            cells = np.concatenate((np.arange(hi - lo), qtms[entries] * bucket_count + nz_buckets[picks] - lo))
+            aligned[lo:hi] = np.bincount(cells, weights=np.concatenate((aligned[lo:hi],
+                                                                        weights[entries] * nz_counts[picks])),
+                                         minlength=hi - lo)
+        return tuple(a[done:] if a is not None else None for a in records)
+
+    held = None
+    for block in blocks:
+        if held is not None:
+            block = tuple(np.concatenate((h, b)) if b is not None else None for h, b in zip(held, block))
+        # the end times of the last records depend on the next block
+        held = align_records(block, max(len(block[0]) - end_lookahead, 0))
+    if held is not None:
+        align_records(held, len(held[0]))
+    return aligned.reshape(time_interval_count, bucket_count)
+
 # add histogram in "source" to histogram in "target"
 # it is assumed that the 2 histograms are precisely time-aligned
-
-def add_to_histo_from( target, source ):
+# returns target, which is replaced by a list
+# if it is a dictionary that became too dense
+
+def add_to_histo_from( target, source, bucket_count=None ):
+    if isinstance(target, dict):
+        for bx, b in histo_items(source):
+            target[bx] = target.get(bx, 0.0) + b
+        return sparsify(target, bucket_count)
+    if isinstance(source, dict):
+        for bx, b in histo_items(source):
+            target[bx] += b
+        return target
     for b in range(0, len(source)):
         target[b] += source[b]
+    return target
 
 
 # calculate total samples in the histogram buckets
 
 def get_samples(buckets):
+    if isinstance(buckets, dict):
+        return reduce( lambda x,y: x + y, [ b for _, b in histo_items(buckets) ], 0.0)
     return reduce( lambda x,y: x + y, buckets)
 
 
@@ -293,7 +655,7 @@ def get_pctiles(buckets, wanted, time_ranges):
 
     # get total of IO requests done
     total_ios = 0
-    for io_count in buckets:
+    for _, io_count in histo_items(buckets):
         total_ios += io_count
 
     # don't return percentiles if no I/O was done during interval
@@ -319,7 +681,7 @@ def get_pctiles(buckets, wanted, time_ranges):
     # all I/O requests up through bucket b
     pct = 0.0
     total_so_far = 0
-    for b, io_count in enumerate(buckets):
+    for b, io_count in histo_items(buckets):
         if io_count == 0:
             continue
         total_so_far += io_count
@@ -352,6 +714,40 @@ def get_pctiles(buckets, wanted, time_ranges):
     assert pctile_index == pctile_count
     return pctile_result
 
+# array version of get_pctiles, for every row of a (time intervals x buckets)
+# array of histograms at once, with the same floating-point operations, so
+# that the results are exactly those of get_pctiles.  a percentile falls in
+# the first bucket whose cumulative percentile exceeds it (or in a later one,
+# as get_pctiles goes through wanted in order), and is interpolated between
+# the cumulative percentile of that bucket and of the one before it.
+# returns the samples of every row, and a (rows x wanted) array of the
+# percentiles, which are NaN in the rows where no I/O was done
+
+def get_pctiles_array(histos, wanted, time_ranges):
+    almost_100 = 99.9999
+    cumulative = np.cumsum(histos, axis=1)
+    total_ios = cumulative[:, -1]
+    ranges = np.asarray(time_ranges, dtype=float)
+    rows = np.arange(len(histos))
+    io_rows = total_ios != 0.0
+    pctiles = np.empty((len(histos), len(wanted)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pct = 100.0 * cumulative / total_ios[:, None]
+        last_bucket = np.zeros(len(histos), dtype=np.intp)
+        for k, next_pctile in enumerate(wanted):
+            if next_pctile == 100.0:
+                reached = pct >= almost_100
+            else:
+                reached = pct > next_pctile
+            assert reached[io_rows].any(axis=1).all()
+            b = np.maximum(np.argmax(reached, axis=1), last_bucket)
+            last_bucket = b
+            last_pct = np.where(b > 0, pct[rows, b - 1], 0.0)
+            offset_frac = (next_pctile - last_pct) / (pct[rows, b] - last_pct)
+            pctiles[:, k] = ranges[b, 0] + (offset_frac * (ranges[b, 1] - ranges[b, 0]))
+    pctiles[~io_rows] = np.nan
+    return (total_ios, pctiles)
+
 
 # this is really the main program
 
@@ -377,9 +773,25 @@ def compute_percentiles_from_logs():
     parser.add_argument("--output-unit", dest="output_unit", 
         default="usec", type=str,
         help="Latency percentile output unit: msec|usec|nsec (default usec)")
+    parser.add_argument("--sparse", dest="sparse",
+        action="store_true", default=False,
+        help="keep histograms with few nonzero buckets as (bucket, count) pairs "
+             "(python engine, which it selects by default)")
+    parser.add_argument("--engine", dest="engine",
+        default=None, choices=["numpy", "python"],
+        help="align histograms as numpy arrays or python lists "
+             "(default=numpy if it is installed, unless --sparse)")
     parser.add_argument("file_list", nargs='+', 
         help='list of files, preceded by " -- " if necessary')
     args = parser.parse_args()
+    if args.engine is None:
+        # the numpy engine only ever works on the nonzero buckets anyway
+        args.engine = "numpy" if np and not args.sparse else "python"
+    if args.engine == 'numpy' and not np:
+        myabort('the numpy engine requires numpy')
+    if args.engine == 'numpy' and args.sparse:
+        myabort('--sparse only applies to the python engine')
+    use_arrays = args.engine == 'numpy'
 
     # default changes based on fio version
     if args.fio_version == 2:
@@ -427,7 +839,13 @@ def compute_percentiles_from_logs():
     hist_files = {}
     for fn in args.file_list:
         try:
-            (hist_files[fn], log_start_time, log_end_time)  = parse_hist_file(fn, buckets_per_interval, args.log_hist_msec)
+            if use_arrays:
+                # the logs are read again, a block at a time, as they are aligned
+                hist_files[fn] = None
+                (log_start_time, log_end_time) = hist_file_time_range(fn, buckets_per_interval, args.log_hist_msec)
+            else:
+                (hist_files[fn], log_start_time, log_end_time)  = parse_hist_file(fn, buckets_per_interval, args.log_hist_msec,
+                                                                                  sparse=args.sparse)
         except FioHistoLogExc as e:
             myabort(str(e))
         # we consider the test started when all threads have started logging
@@ -443,19 +861,39 @@ def compute_percentiles_from_logs():
                time.ctime(test_start_time/1000.0)))
 
     (end_time, time_interval_count) = get_time_intervals(args.time_quantum, test_start_time, test_end_time)
-    all_threads_histograms = [ ((j*args.time_quantum*msec_per_sec), deepcopy(zeroed_buckets))
-                               for j in range(0, time_interval_count) ]
-
-    for logfn in hist_files.keys():
-        aligned_per_thread = align_histo_log(hist_files[logfn], 
-                                             args.time_quantum, 
-                                             buckets_per_interval, 
-                                             test_start_time,
-                                             test_end_time)
-        for t in range(0, time_interval_count):
-            (_, all_threads_histo_t) = all_threads_histograms[t]
-            (_, log_histo_t) = aligned_per_thread[t]
-            add_to_histo_from( all_threads_histo_t, log_histo_t )
+    if use_arrays:
+        all_threads_array = np.zeros((time_interval_count, buckets_per_interval))
+        for logfn in hist_files.keys():
+            try:
+                all_threads_array += align_hist_blocks(read_hist_blocks(logfn, buckets_per_interval),
+                                                       args.time_quantum,
+                                                       buckets_per_interval,
+                                                       test_start_time,
+                                                       test_end_time)
+            except FioHistoLogExc as e:
+                myabort(str(e))
+        (samples, pctiles) = get_pctiles_array(all_threads_array, args.pctiles_wanted, bucket_times)
+        interval_pctiles = ( ((j*args.time_quantum*msec_per_sec), samples_t,
+                              dict(zip(args.pctiles_wanted, pctiles_t)) if samples_t != 0.0 else None)
+                             for j, (samples_t, pctiles_t) in enumerate(zip(samples.tolist(), pctiles.tolist())) )
+    else:
+        all_threads_histograms = [ ((j*args.time_quantum*msec_per_sec), {} if args.sparse else deepcopy(zeroed_buckets))
+                                   for j in range(0, time_interval_count) ]
+        for logfn in hist_files.keys():
+            aligned_per_thread = align_histo_log(hist_files[logfn], 
+                                                 args.time_quantum, 
+                                                 buckets_per_interval, 
+                                                 test_start_time,
+                                                 test_end_time,
+                                                 sparse=args.sparse)
+            for t in range(0, time_interval_count):
+                (t_msec, all_threads_histo_t) = all_threads_histograms[t]
+                (_, log_histo_t) = aligned_per_thread[t]
+                all_threads_histograms[t] = (t_msec,
+                    add_to_histo_from( all_threads_histo_t, log_histo_t, buckets_per_interval ))
+        interval_pctiles = ( (t_msec, get_samples(all_threads_histo_t),
+                              get_pctiles(all_threads_histo_t, args.pctiles_wanted, bucket_times))
+                             for (t_msec, all_threads_histo_t) in all_threads_histograms )
 
     # calculate percentiles across aggregate histogram for all threads
     # print CSV header just like fiologparser_hist does
@@ -475,10 +913,8 @@ def compute_percentiles_from_logs():
     print('time (millisec), percentiles in increasing order with values in ' + args.output_unit)
     print(header)
 
-    for (t_msec, all_threads_histo_t) in all_threads_histograms:
-        samples = get_samples(all_threads_histo_t)
+    for (t_msec, samples, pct) in interval_pctiles:
         record = '%8d, %8d, ' % (t_msec, samples)
-        pct = get_pctiles(all_threads_histo_t, args.pctiles_wanted, bucket_times)
         if not pct:
             for w in args.pctiles_wanted:
                 record += ', '
@@ -761,6 +1197,106 @@ if unittest2_imported:
         pct = get_pctiles( histo, [ 100.0 ], time_intervals )
         self.A(pct == expected_pctiles)
 
+    # sparse histograms must give the same results as dense ones
+    def test_f1_sparse_histos(self):
+        fio_v3_bucket_count = 29 * 64
+        with open(self.fn, 'w') as f:
+            for t, bx in [ (2000, 100), (4000, 101), (7000, 900) ]:
+                buckets = [ 0 for j in range(0, fio_v3_bucket_count) ]
+                buckets[bx] = 3
+                buckets[bx + 5] = 1
+                f.write('%d, 1, 4096, %s\n' % (t, ', '.join([str(b) for b in buckets])))
+        (dense_log, min_timestamp_ms, max_timestamp_ms) = parse_hist_file(self.fn, fio_v3_bucket_count, None)
+        (sparse_log, _, _) = parse_hist_file(self.fn, fio_v3_bucket_count, None, sparse=True)
+        (_, _, _, histo) = sparse_log[0]
+        self.A(histo == { 100:3, 105:1 })
+        dense = align_histo_log(dense_log, 5, fio_v3_bucket_count, min_timestamp_ms, max_timestamp_ms)
+        sparse = align_histo_log(sparse_log, 5, fio_v3_bucket_count, min_timestamp_ms, max_timestamp_ms,
+                                 sparse=True)
+        time_intervals = time_ranges(29, 64)
+        for ((_, dh), (_, sh)) in zip(dense, sparse):
+            self.A(isinstance(sh, dict))
+            self.A(get_samples(dh) == get_samples(sh))
+            self.A(get_pctiles(dh, [ 0., 50., 99., 100. ], time_intervals) ==
+                   get_pctiles(sh, [ 0., 50., 99., 100. ], time_intervals))
+
+    def test_f2_sparse_to_dense(self):
+        h = add_to_histo_from( {}, { 1:1.0 }, 4 )
+        self.A(h == { 1:1.0 })
+        h = add_to_histo_from( h, { 2:2.0 }, 4 )
+        self.A(h == [ 0.0, 1.0, 2.0, 0.0 ])
+        h = add_to_histo_from( h, { 3:1.5 }, 4 )
+        self.A(h == [ 0.0, 1.0, 2.0, 1.5 ])
+
+    # the array engine must give the same histograms as align_histo_log
+    def test_g1_align_histo_array(self):
+        if not np:
+            return
+        with open(self.fn, 'w') as f:
+            for t, direction in [ (2000, 0), (2010, 1), (7000, 1), (6990, 0), (9500, 0), (12000, 1) ]:
+                f.write('%d, %d, 4096, %d, 2, 0, %d\n' % (t, direction, t % 7, direction))
+        (raw_histo_log, min_timestamp_ms, max_timestamp_ms) = parse_hist_file(self.fn, 4, None)
+        for quantum in [ 1, 2, 5 ]:
+            aligned_log = align_histo_log(raw_histo_log, quantum, 4, min_timestamp_ms, max_timestamp_ms)
+            aligned = align_histo_array(raw_histo_log, quantum, 4, min_timestamp_ms, max_timestamp_ms)
+            self.A(aligned.tolist() == [ h for (_, h) in aligned_log ])
+        # records before the test start only count from the start on
+        aligned_log = align_histo_log(raw_histo_log, 1, 4, 4000, max_timestamp_ms)
+        aligned = align_histo_array(raw_histo_log, 1, 4, 4000, max_timestamp_ms)
+        self.A(aligned.tolist() == [ h for (_, h) in aligned_log ])
+        self.A(self.is_close(aligned[0], [ 6000 / 4990., 4000 / 4990., 0., 1000 / 4990. ]))
+
+    # records and errors must not depend on where the log is cut into blocks
+    def test_g2_read_hist_blocks(self):
+        global hist_block_bytes
+        if not np:
+            return
+        with open(self.fn, 'w') as f:
+            for t in range(1000, 31000, 500):
+                f.write('%d, %d, 4096, %d, 2, 0, %d\n' % (t, t % 3 == 0, t % 7, t % 11))
+        saved_block_bytes = hist_block_bytes
+        hist_block_bytes = 100
+        try:
+            self.A(len(list(read_hist_blocks(self.fn, 4))) > 1)
+            raw_histo_log = list(read_hist_lines(self.fn, 4))
+            self.A(list(block_records(read_hist_blocks(self.fn, 4))) == raw_histo_log)
+            aligned_log = align_histo_log(raw_histo_log, 2, 4, 1000, 30500)
+            aligned = align_hist_blocks(read_hist_blocks(self.fn, 4), 2, 4, 1000, 30500)
+            self.A(aligned.tolist() == [ h for (_, h) in aligned_log ])
+
+            with open(self.fn, 'a') as f:
+                f.write('30000, 0, 4096, 1, 2, 3, 4\n')
+            for read_records in [ read_hist_lines, read_hist_blocks ]:
+                try:
+                    list(read_records(self.fn, 4))
+                    self.A(False)
+                except FioHistoLogExc as e:
+                    self.A(str(e) == 'read timestamp in column 1 decreased in histogram record 62 file %s' % self.fn)
+        finally:
+            hist_block_bytes = saved_block_bytes
+
+    # percentiles of the aligned array must be exactly those of get_pctiles
+    def test_g3_pctiles_array(self):
+        if not np:
+            return
+        time_intervals = time_ranges(4, 32)
+        histos = [ [ 0.0 ] * 128 for j in range(5) ]
+        histos[0][3] = 1.0
+        for b in range(0, 128, 7):
+            histos[1][b] = b / 3.0
+            histos[3][127 - b] = 1.0 / (b + 1)
+        histos[4][10] = 10000.0
+        histos[4][100] = 0.5
+        for wanted in [ [ 0., 50., 99., 100. ], [ 99., 50., 50., 100., 0., 99.99 ] ]:
+            (samples, pctiles) = get_pctiles_array(np.array(histos), wanted, time_intervals)
+            for j, histo in enumerate(histos):
+                self.A(samples[j] == get_samples(histo))
+                pct = get_pctiles(histo, wanted, time_intervals)
+                if not pct:
+                    self.A(np.isnan(pctiles[j]).all())
+                else:
+                    self.A(dict(zip(wanted, pctiles[j].tolist())) == pct)
+
 # we are using this module as a standalone program
 
 if __name__ == '__main__':
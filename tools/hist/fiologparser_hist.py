@@ -10,63 +10,37 @@
             2000, 43, 152, 1642.368, 1714.099, 1816.659, 1845.552, 1888.131, 1888.000
             4000, 39, 1152, 1546.962, 1545.785, 1627.192, 1640.019, 1691.204, 1744
             ...
+
+    The same statistics are available in-process as namedtuples, computed
+    lazily as the logs are read:
+
+            from fiologparser_hist import HistReader
+            for rec in HistReader(['job_clat_hist.1.log'], interval=500):
+                print(rec.end, rec.samples, rec.median, rec.percentiles)
     
     @author Karl Cronburg <karl.cronburg@gmail.com>
 """
+import collections
+import copy
+import heapq
+import itertools
 import os
 import sys
-import pandas
 import re
+import select
+import stat
+import tempfile
+import time
 import numpy as np
+# fiolog.py is installed next to this script, and lives in tools/ in the source tree
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fiolog import BLOCK_SIZE, is_compressed, open_log, parse_block, parse_log, load_cache, CacheWriter, \
+    bin_table
 
 runascmd = False
 
 err = sys.stderr.write
 
-class HistFileRdr():
-    """ Class to read a hist file line by line, buffering
-        a value array for the latest line, and allowing a preview
-        of the next timestamp in next line
-        Note: this does not follow a generator pattern, but must explicitly
-        get next bin array.
-    """
-    def __init__(self, file):
-        self.fp = open(file, 'r')
-        self.data = self.nextData()
-
-    def close(self):
-        self.fp.close()
-        self.fp = None
-
-    def nextData(self):
-        self.data = None
-        if self.fp:
-            line = self.fp.readline()
-            if line == "":
-                self.close()
-            else:
-                self.data = [int(x) for x in line.replace(' ', '').rstrip().split(',')]
-
-        return self.data
-
-    @property
-    def curTS(self):
-        ts = None
-        if self.data:
-            ts = self.data[0]
-        return ts
-
-    @property
-    def curDir(self):
-        d = None
-        if self.data:
-            d = self.data[1]
-        return d
-
-    @property
-    def curBins(self):
-        return self.data[3:]
-
 def weighted_percentile(percs, vs, ws):
     """ Use linear interpolation to calculate the weighted percentile.
         
@@ -111,21 +85,18 @@ def weights(start_ts, end_ts, start, end):
 def weighted_average(vs, ws):
     return np.sum(vs * ws) / np.sum(ws)
 
-
-percs = None
-columns = None
-
 def gen_output_columns(ctx):
-    global percs,columns
+    """ Set ctx.percs to the percentiles to compute and ctx.columns to the
+        names of the output columns. """
     strpercs = re.split('[,:]', ctx.percentiles)
-    percs = [50.0]  # always print 50% in 'median' column
-    percs.extend(list(map(float,strpercs)))
+    ctx.percs = [50.0]  # always print 50% in 'median' column
+    ctx.percs.extend(list(map(float,strpercs)))
     if ctx.directions:
-        columns = ["end-time", "dir", "samples", "min", "avg", "median"]
+        ctx.columns = ["end-time", "dir", "samples", "min", "avg", "median"]
     else:
-        columns = ["end-time", "samples", "min", "avg", "median"]
-    columns.extend(list(map(lambda x: x+'%', strpercs)))
-    columns.append("max")
+        ctx.columns = ["end-time", "samples", "min", "avg", "median"]
+    ctx.columns.extend(list(map(lambda x: x+'%', strpercs)))
+    ctx.columns.append("max")
 
 def fmt_float_list(ctx, num=1):
   """ Return a comma separated list of float formatters to the required number
@@ -135,139 +106,306 @@ def fmt_float_list(ctx, num=1):
   """
   return ', '.join(["%%.%df" % ctx.decimals] * num)
 
-# Default values - see beginning of main() for how we detect number columns in
-# the input files:
-__HIST_COLUMNS = 1216
+# Columns before the histogram bins in the input files - see setup() for how
+# we detect the number of bins:
 __NON_HIST_COLUMNS = 3
-__TOTAL_COLUMNS = __HIST_COLUMNS + __NON_HIST_COLUMNS
 
-def read_chunk(rdr, sz):
-    """ Read the next chunk of size sz from the given reader. """
+# Parsed logs are cached in a compact, memory-mappable file next to each
+# log, in the same format as tools/fiologparser.py uses (see
+# tools/fiolog.py), so re-running with a different --interval or
+# --percentiles does not parse the log text again.  The first
+# __NON_HIST_COLUMNS columns are kept dense and the mostly-empty bins as
+# their nonzero entries.
+
+def read_hist_chunks(ctx, fn, sz, after=None, offset=0, end=None):
+    """ Yield the rows of the given hist file as integer arrays of up to
+        sz rows, from the cache of the file when there is a valid one.
+        Otherwise the file is parsed, building the cache along the way
+        unless ctx.cache is False.
+
+        With after, only the rows later than that time are yielded.  The
+        log text may be limited to the lines from byte offset to byte end,
+        which must hold all the rows needed (see log_index()). """
+    if getattr(ctx, 'follow', False):
+        for arr in follow_hist_chunks(ctx, fn, sz):
+            yield arr
+        return
+
+    use_cache = getattr(ctx, 'cache', True)
+    cache = load_cache(fn) if use_cache else None
+    if cache is not None:
+        if cache.rows == 0 and ctx.warn:
+            sys.stderr.write("WARNING: Empty input file encountered.\n")
+        for arr in cache.blocks(after):
+            for i in range(0, len(arr), sz):
+                yield arr[i:i + sz]
+        return
+
+    # only a cache of the whole log is kept
+    whole = after is None and offset == 0 and end is None
+    writer = CacheWriter(fn, __NON_HIST_COLUMNS) if use_cache and whole else None
+    empty = True
     try:
-        """ StopIteration occurs when the pandas reader is empty, and AttributeError
-            occurs if rdr is None due to the file being empty. """
-        new_arr = rdr.read().values
-    except (StopIteration, AttributeError):
-        return None
-
-    # Let's leave the array as is, and let later code ignore the block size
-    return new_arr
-
-    #""" Extract array of the times, directions wo times, and histograms matrix without times column. """
-    #times, rws, szs = new_arr[:,0], new_arr[:,1], new_arr[:,2]
-    #hists = new_arr[:,__NON_HIST_COLUMNS:]
-    #times = times.reshape((len(times),1))
-    #dirs  = rws.reshape((len(rws),1))
-    #arr = np.append(times, hists, axis=1)
-    #return arr
-
-def get_min(fps, arrs):
-    """ Find the file with the current first row with the smallest start time """
-    return min([fp for fp in fps if not arrs[fp] is None], key=lambda fp: arrs.get(fp)[0][0])
-
-def histogram_generator(ctx, fps, sz):
-    
-    # Create a chunked pandas reader for each of the files:
-    rdrs = {}
-    for fp in fps:
+        for arr in parse_log(fn, offset, end):
+            empty = False
+            if after is not None:
+                arr = arr[np.searchsorted(arr[:,0], after, side='right'):]
+                if len(arr) > 0:
+                    # the rest of the log is later
+                    after = None
+            if writer:
+                writer.append(arr)
+            for i in range(0, len(arr), sz):
+                yield arr[i:i + sz]
+        if empty and ctx.warn:
+            sys.stderr.write("WARNING: Empty input file encountered.\n")
+        if writer:
+            writer.commit()
+    finally:
+        if writer:
+            writer.abort()
+
+# With --follow, the logs are read while fio is still writing them.  Each
+# one is read from where the last read stopped, and only its complete
+# lines are converted, so the reader keeps no more than one block of text
+# and rows.  When it has no new lines, the reader waits for the log to
+# grow: on Linux with an inotify watch, so that nothing is done until fio
+# writes to it, elsewhere by checking its size every FOLLOW_POLL seconds.
+# A log which has not grown for --follow_timeout seconds is taken to be
+# complete.
+
+FOLLOW_POLL = 0.2
+
+class LogWatcher(object):
+    """ Wait for a log to grow beyond a given size. """
+    def __init__(self, fn):
+        self.fn = fn
+        self.fd = None
         try:
-            rdrs[fp] = pandas.read_csv(fp, dtype=int, header=None, chunksize=sz)
-        except ValueError as e:
-            if e.message == 'No columns to parse from file':
-                if ctx.warn: sys.stderr.write("WARNING: Empty input file encountered.\n")
-                rdrs[fp] = None
-            else:
-                raise(e)
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+            if fd >= 0:
+                IN_MODIFY = 0x2
+                if libc.inotify_add_watch(fd, fn.encode(), IN_MODIFY) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+        except (ImportError, OSError, AttributeError, TypeError):
+            pass
+
+    def wait(self, size, timeout=None):
+        """ Return True once the log is larger than size, or False if it did
+            not grow for timeout seconds (None waits forever). """
+        deadline = None if timeout is None else time.time() + timeout
+        while os.stat(self.fn).st_size <= size:
+            left = None if deadline is None else deadline - time.time()
+            if left is not None and left <= 0:
+                return False
+            if self.fd is None:
+                time.sleep(FOLLOW_POLL if left is None else min(FOLLOW_POLL, left))
+                continue
+            # also wake up now and then, in case an event is missed (NFS)
+            wake = 10 * FOLLOW_POLL if left is None else min(10 * FOLLOW_POLL, left)
+            if select.select([self.fd], [], [], wake)[0]:
+                try:
+                    while os.read(self.fd, 4096):
+                        pass
+                except OSError:
+                    pass
+        return True
 
-    # Initial histograms from disk:
-    arrs = {fp: read_chunk(rdr, sz) for fp,rdr in rdrs.items()}
-    while True:
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def follow_hist_chunks(ctx, fn, sz):
+    """ Yield the rows of the hist file fn as integer arrays of up to sz
+        rows, as fio appends them, until it has not grown for
+        ctx.follow_timeout seconds. """
+    watcher = LogWatcher(fn)
+    ncols = None
+    rest = b''
+    try:
+        with open(fn, 'rb') as f:
+            while True:
+                data = f.read(BLOCK_SIZE)
+                if not data:
+                    if watcher.wait(f.tell(), ctx.follow_timeout):
+                        continue
+                    # the log is complete, its last line may lack a newline
+                    data, rest = rest.strip(), b''
+                    if not data:
+                        return
+                else:
+                    data = rest + data
+                    cut = data.rfind(b'\n') + 1
+                    data, rest = data[:cut].strip(), data[cut:]
+                    if not data:
+                        continue
+                if ncols is None:
+                    ncols = data.split(b'\n', 1)[0].count(b',') + 1
+                arr = parse_block(fn, data, ncols)
+                for i in range(0, len(arr), sz):
+                    yield arr[i:i + sz]
+    finally:
+        watcher.close()
+
+def histogram_generator(ctx, fps, sz, starts=None, shifts=None):
+    """ Yield the rows of all the given files merged in time order, in
+        blocks, with the index of its file inserted as the second column of
+        every row.
+
+        Each file is read sz rows at a time. As the rows of a file are in
+        time order, no row still to be read can be earlier than the last
+        row read from its file. So all buffered rows earlier than the
+        smallest such time among the files not read to the end are final:
+        they are merged with one stable sort, which keeps rows of equal
+        times in file order, and yielded as one block.
+
+        starts optionally gives the (after, offset, end) arguments of
+        read_hist_chunks for every file, and shifts the number of ms to
+        subtract from the times of its rows.
+    """
 
-        try:
-            """ ValueError occurs when nothing more to read """
-            fp = get_min(fps, arrs)
-        except ValueError:
+    # Create a chunked reader for each of the files:
+    if starts is None:
+        starts = [(None, 0, None)] * len(fps)
+    rdrs = [read_hist_chunks(ctx, fp, sz, *st) for fp, st in zip(fps, starts)]
+    bufs = [None] * len(fps)    # rows read from each file
+    pos = [0] * len(fps)        # index of the first row not yet yielded
+    live = [True] * len(fps)    # whether the file has more rows
+
+    def refill(i):
+        arr = next(rdrs[i], None)
+        if arr is None:
+            live[i] = False
             return
-        arr = arrs[fp]
-        arri = np.insert(arr[0], 1, fps.index(fp))
-        yield arri
-        arrs[fp] = arr[1:]
-
-        if arrs[fp].shape[0] == 0:
-            arrs[fp] = read_chunk(rdrs[fp], sz)
-
-def _plat_idx_to_val(idx, edge=0.5, FIO_IO_U_PLAT_BITS=6, FIO_IO_U_PLAT_VAL=64):
-    """ Taken from fio's stat.c for calculating the latency value of a bin
-        from that bin's index.
-        
-            idx  : the value of the index into the histogram bins
-            edge : fractional value in the range [0,1]** indicating how far into
-            the bin we wish to compute the latency value of.
-        
-        ** edge = 0.0 and 1.0 computes the lower and upper latency bounds
-           respectively of the given bin index. """
-
-    # MSB <= (FIO_IO_U_PLAT_BITS-1), cannot be rounded off. Use
-    # all bits of the sample as index
-    if (idx < (FIO_IO_U_PLAT_VAL << 1)):
-        return idx 
+        arr = np.insert(arr, 1, i, axis=1)
+        if shifts is not None:
+            arr[:,0] -= shifts[i]
+        bufs[i] = arr if bufs[i] is None else np.concatenate((bufs[i][pos[i]:], arr))
+        pos[i] = 0
 
-    # Find the group and compute the minimum value of that group
-    error_bits = (idx >> FIO_IO_U_PLAT_BITS) - 1 
-    base = 1 << (error_bits + FIO_IO_U_PLAT_BITS)
+    try:
+        while True:
+            for i in range(len(fps)):
+                while live[i] and (bufs[i] is None or pos[i] == len(bufs[i])):
+                    refill(i)
+            lasts = [bufs[i][-1][0] for i in range(len(fps)) if live[i]]
+            horizon = min(lasts) if lasts else None
+
+            parts = []
+            for i, buf in enumerate(bufs):
+                if buf is None:
+                    continue
+                n = len(buf) - pos[i]
+                if horizon is not None:
+                    n = np.searchsorted(buf[pos[i]:,0], horizon)
+                if n > 0:
+                    parts.append(buf[pos[i]:pos[i] + n])
+                    pos[i] += n
+
+            if parts:
+                block = np.concatenate(parts)
+                yield block[np.argsort(block[:,0], kind='mergesort')]
+            elif horizon is None:
+                return
+            else:
+                # only rows at the horizon are left, read further
+                for i in range(len(fps)):
+                    if live[i] and bufs[i][-1][0] == horizon:
+                        refill(i)
+    finally:
+        for rdr in rdrs:
+            rdr.close()
 
-    # Find its bucket number of the group
-    k = idx % FIO_IO_U_PLAT_VAL
+# The statistics of one interval and direction, divided by --divisor.
+# percentiles holds the percentiles following the median in --percentiles.
+IntervalStats = collections.namedtuple('IntervalStats',
+                                       'end dir samples min avg median percentiles max')
 
-    # Return the mean (if edge=0.5) of the range of the bucket
-    return base + ((k + edge) * (1 << error_bits))
-    
-def plat_idx_to_val_coarse(idx, coarseness, edge=0.5):
-    """ Converts the given *coarse* index into a non-coarse index as used by fio
-        in stat.h:plat_idx_to_val(), subsequently computing the appropriate
-        latency value for that bin.
-        """
-
-    # Multiply the index by the power of 2 coarseness to get the bin
-    # bin index with a max of 1536 bins (FIO_IO_U_PLAT_GROUP_NR = 24 in stat.h)
-    stride = 1 << coarseness
-    idx = idx * stride
-    lower = _plat_idx_to_val(idx, edge=0.0)
-    upper = _plat_idx_to_val(idx + stride, edge=1.0)
-    return lower + (upper - lower) * edge
-
-def print_all_stats(ctx, end, mn, ss_cnt, vs, ws, mx, dir=dir):
-    ps = weighted_percentile(percs, vs, ws)
+def get_stats(ctx, end, mn, ss_cnt, vs, ws, mx, dir=dir):
+    ps = weighted_percentile(ctx.percs, vs, ws)
 
     avg = weighted_average(vs, ws)
-    values = [mn, avg] + list(ps) + [mx]
+    values = [float(x) / ctx.divisor for x in [mn, avg] + list(ps) + [mx]]
+    return IntervalStats(int(end), dir, int(ss_cnt), values[0], values[1], values[2],
+                         values[3:-1], values[-1])
+
+# The histogram behind the IntervalStats of an interval, kept for --store:
+# the min and max before --divisor, and the numbers and weights of its
+# nonzero bins.
+IntervalHist = collections.namedtuple('IntervalHist', 'min max bins weights')
+
+def interval_record(ctx, end, mn, ss_cnt, bins, ws, mx, dir):
+    """ Return the IntervalStats of the interval histogram ws, whose bin
+        numbers are bins, or all bins when bins is None, along with its
+        IntervalHist with --store or for a host of --hosts, or None. """
+    partial = getattr(ctx, 'partial', False)
+    if partial:
+        # the interval of one host of --hosts, whose statistics are only
+        # computed once the hosts are added up (see host_interval_data())
+        stats = IntervalStats(end, dir, ss_cnt, None, None, None, None, None)
+    else:
+        vs = ctx.bin_vals if bins is None else ctx.bin_vals[bins]
+        stats = get_stats(ctx, end, mn, ss_cnt, vs, ws, mx, dir=dir)
+    hist = None
+    if partial or getattr(ctx, 'store', None):
+        nz = np.flatnonzero(ws)
+        hist = IntervalHist(mn, mx, nz if bins is None else bins[nz], ws[nz])
+    return stats, hist
+
+def print_all_stats(ctx, stats):
     if ctx.directions:
-        row = [end, dir, ss_cnt]
+        row = [stats.end, stats.dir, stats.samples]
         fmt = "%d, %s, %d, "
     else:
-        row = [end, ss_cnt]
+        row = [stats.end, stats.samples]
         fmt = "%d, %d, "
-    row = row + [float(x) / ctx.divisor for x in values]
+    row = row + [stats.min, stats.avg, stats.median] + list(stats.percentiles) + [stats.max]
     if ctx.divisor > 1:
-        fmt = fmt + fmt_float_list(ctx, len(percs)+3)
+        fmt = fmt + fmt_float_list(ctx, len(ctx.percs)+3)
     else:
         # max and min are decimal values if no divisor
-        fmt = fmt + "%d, " + fmt_float_list(ctx, len(percs)+1) + ", %d"
+        fmt = fmt + "%d, " + fmt_float_list(ctx, len(ctx.percs)+1) + ", %d"
 
     print (fmt % tuple(row))
 
-def update_extreme(val, fncn, new_val):
-    """ Calculate min / max in the presence of None values """
-    if val is None: return new_val
-    else: return fncn(val, new_val)
-
-# See beginning of main() for how bin_vals are computed
-bin_vals = []
-lower_bin_vals = [] # lower edge of each bin
-upper_bin_vals = [] # upper edge of each bin 
+# Latency histograms are mostly empty: of the 1216 or 1856 bins of a row,
+# typically a few dozen are nonzero.  With --sparse, the histogram of an
+# interval is kept as the (bin, weight) pairs of its nonzero bins, and the
+# percentiles are interpolated over those, as long as no more than
+# SPARSE_DENSITY of the bins are used; denser histograms are made dense.
+SPARSE_DENSITY = 0.25
+
+def sparse_bins(nonzero, nbins):
+    """ Return the sorted bin numbers of the sparse histogram with the given
+        nonzero bins, or None if it is too dense.
+
+        The bins next to the nonzero ones are kept with zero weight: they
+        are the points the interpolation of weighted_percentile() over the
+        dense histogram runs through between nonzero bins, so the
+        percentiles come out the same.  Only the 100th percentile differs,
+        which is the bin above the last nonzero one rather than the last
+        bin of the dense histogram. """
+    if len(nonzero) > SPARSE_DENSITY * nbins:
+        return None
+    knots = np.unique(np.concatenate((nonzero - 1, nonzero, nonzero + 1)))
+    return knots[(knots >= 0) & (knots < nbins)]
+
+def sparse_hist(bins, ws, nbins):
+    """ Return the bin numbers and summed weights of the histogram of the
+        (bin, weight) pairs bins and ws, or None if it is too dense. """
+    knots = sparse_bins(np.unique(bins), nbins)
+    if knots is None:
+        return None
+    return knots, np.bincount(np.searchsorted(knots, bins), weights=ws, minlength=len(knots))
 
 def process_interval(ctx, iHist, iEnd, dir):
-    """ print estimated percentages for the given merged sample
+    """ Return the interval_record() with the estimated percentages for the
+        given merged sample, or None if it holds no samples.
     """
     ss_cnt = 0 # number of samples affecting this interval
     mn_bin_val, mx_bin_val = None, None
@@ -278,57 +416,74 @@ def process_interval(ctx, iHist, iEnd, dir):
     # Update min and max bin values
     idxs = np.nonzero(iHist != 0)[0]
     if idxs.size > 0:
-        mn_bin_val = bin_vals[idxs[0]]
-        mx_bin_val = bin_vals[idxs[-1]]
+        mn_bin_val = ctx.bin_vals[idxs[0]]
+        mx_bin_val = ctx.bin_vals[idxs[-1]]
+
+    ws = iHist
+    knots = sparse_bins(idxs, len(iHist)) if ctx.sparse else None
+    if knots is not None:
+        ws = iHist[knots]
 
-    if ss_cnt > 0: print_all_stats(ctx, iEnd, mn_bin_val, ss_cnt, bin_vals, iHist, mx_bin_val, dir=dir)
+    if ss_cnt > 0: return interval_record(ctx, iEnd, mn_bin_val, ss_cnt, knots, ws, mx_bin_val, dir)
 
 
 dir_map = ['r', 'w', 't']  # map of directional value in log to textual representation
+
+def nonzero_entries(samples):
+    """ Return the nonzero bins of the given merged rows as an integer
+        matrix of (time, direction, bin, count) entries, in row order. """
+    hists = samples[:,4:]
+    # (much faster than np.nonzero() on the 2-D array)
+    rows, bins = divmod(np.flatnonzero(hists != 0), hists.shape[1])
+    return np.column_stack((samples[rows,0], samples[rows,2], bins, hists[rows, bins]))
+
 def process_weighted_interval(ctx, samples, iStart, iEnd, printdirs):
     """ Construct the weighted histogram for the given interval by scanning
         through all the histograms and figuring out which of their bins have
         samples with latencies which overlap with the given interval
-        [iStart,iEnd].
-    """
+        [iStart,iEnd]. Return the interval_record() of each direction.
 
-    times, files, dirs, sizes, hists = samples[:,0], samples[:,1], samples[:,2], samples[:,3], samples[:,4:]
-    iHist={}; ss_cnt = {}; mn_bin_val={}; mx_bin_val={}
-    for dir in printdirs:
-        iHist[dir] = np.zeros(__HIST_COLUMNS, dtype=float)
-        ss_cnt[dir] = 0 # number of samples affecting this interval
-        mn_bin_val[dir] = None
-        mx_bin_val[dir] = None
-
-    for end_time,file,dir,hist in zip(times,files,dirs,hists):
-
-        # Only look at bins of the current histogram sample which
-        # started before the end of the current time interval [start,end]
-        start_times = (end_time - 0.5 * ctx.interval) - bin_vals / ctx.time_divisor
-        idx = np.where(start_times < iEnd)
-        s_ts, l_bvs, u_bvs, hs = start_times[idx], lower_bin_vals[idx], upper_bin_vals[idx], hist[idx]
-
-        # Increment current interval histogram by weighted values of future histogram
-        # total number of samples
-        # and min and max values as necessary
-        textdir = dir_map[dir]
-        ws = hs * weights(s_ts, end_time, iStart, iEnd)
-        mmidx = np.where(hs != 0)[0]
-        if 'm' in printdirs:
-            iHist['m'][idx] += ws
-            ss_cnt['m'] += np.sum(hs)
-            if mmidx.size > 0:
-                mn_bin_val['m'] = update_extreme(mn_bin_val['m'], min, l_bvs[max(0,           mmidx[0]  - 1)])
-                mx_bin_val['m'] = update_extreme(mx_bin_val['m'], max, u_bvs[min(len(hs) - 1, mmidx[-1] + 1)])
-        if textdir in printdirs:
-            iHist[textdir][idx] += ws
-            ss_cnt[textdir] += np.sum(hs)  # Update total number of samples affecting current interval histogram:
-            if mmidx.size > 0:
-                mn_bin_val[textdir] = update_extreme(mn_bin_val[textdir], min, l_bvs[max(0,           mmidx[0]  - 1)])
-                mx_bin_val[textdir] = update_extreme(mx_bin_val[textdir], max, u_bvs[min(len(hs) - 1, mmidx[-1] + 1)])
+        The whole window is processed at once. Only the nonzero bins of the
+        histograms contribute, so rather than a (rows x bins) matrix the
+        kernel works on the entries of nonzero_entries(). With --sparse,
+        the window is kept as those entries, and so are the interval
+        histograms (see sparse_hist()).
+    """
 
+    entries = samples if ctx.sparse else nonzero_entries(samples)
+    times, dirs, bins, hs = entries.T
+    nbins = len(ctx.bin_vals)
+
+    # Only look at bins of each histogram sample which
+    # started before the end of the current time interval [start,end]
+    def start_time(times, bins):
+        return (times - 0.5 * ctx.interval) - ctx.bin_vals[bins] / ctx.time_divisor
+    s_ts = start_time(times, bins)
+    used = s_ts < iEnd
+    times, dirs, bins, hs, s_ts = times[used], dirs[used], bins[used], hs[used], s_ts[used]
+    ws = hs * weights(s_ts, times, iStart, iEnd)
+
+    # The min (max) of a histogram is the lower (upper) edge of the bin
+    # below its first (above its last) nonzero bin, if that bin is used too.
+    below = np.maximum(bins - 1, 0)
+    below = np.where(start_time(times, below) < iEnd, below, bins)
+    above = np.minimum(bins + 1, nbins - 1)
+    mins, maxs = ctx.lower_bin_vals[below], ctx.upper_bin_vals[above]
+
+    records = []
     for textdir in sorted(printdirs):
-        if ss_cnt[textdir] > 0: print_all_stats(ctx, iEnd, mn_bin_val[textdir], ss_cnt[textdir], bin_vals, iHist[textdir], mx_bin_val[textdir], dir=textdir)
+        if textdir == 'm':
+            sel = slice(None)
+        else:
+            sel = dirs == dir_map.index(textdir)
+        ss_cnt = hs[sel].sum()  # total number of samples affecting this interval
+        if ss_cnt > 0:
+            hist = sparse_hist(bins[sel], ws[sel], nbins) if ctx.sparse else None
+            if hist is None:
+                hist = None, np.bincount(bins[sel], weights=ws[sel], minlength=nbins)
+            records.append(interval_record(ctx, iEnd, mins[sel].min(), ss_cnt, hist[0],
+                                           hist[1], maxs[sel].max(), textdir))
+    return records
 
 def guess_max_from_bins(ctx, hist_cols):
     """ Try to guess the GROUP_NR from given # of histogram
@@ -346,7 +501,7 @@ def guess_max_from_bins(ctx, hist_cols):
     if len(idx[1]) == 0:
         table = repr(arr.astype(int)).replace('-10', 'N/A').replace('array','     ')
         errmsg = ("Unable to determine bin values from input clat_hist files. Namely \n"
-            "the first line of file '%s' " % ctx.FILE[0] + "has %d \n" % (__TOTAL_COLUMNS,) +
+            "the first line of file '%s' " % ctx.FILE[0] + "has %d \n" % (hist_cols + __NON_HIST_COLUMNS,) +
             "columns of which we assume %d " % (hist_cols,) + "correspond to histogram bins. \n"
             "This number needs to be equal to one of the following numbers:\n\n"
             + table + "\n\n"
@@ -362,112 +517,642 @@ def guess_max_from_bins(ctx, hist_cols):
 
     return bins[idx[1][0]]
 
-def output_weighted_interval_data(ctx,printdirs):
+class RowBuffer():
+    """ Window of histogram rows, preallocated and grown by doubling.
+
+        Rows are appended in place after the last live row, and rows at
+        the front are retired by advancing the head index, so neither
+        copies the window. When the end of the storage is reached, the live
+        rows are moved back to the front, or into storage twice as large
+        when they fill more than half of it; either happens at most once
+        per as many appends as there are live rows, keeping the cost per
+        row constant.
+    """
+    def __init__(self, cols, capacity=1024):
+        self.buf = np.empty(shape=(capacity, cols), dtype=int)
+        self.head = 0
+        self.tail = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    @property
+    def rows(self):
+        """ View of the live rows """
+        return self.buf[self.head:self.tail]
+
+    def extend(self, rows):
+        if self.tail + len(rows) > len(self.buf):
+            self._compact(len(rows))
+        self.buf[self.tail:self.tail + len(rows)] = rows
+        self.tail += len(rows)
+
+    def _compact(self, n):
+        """ Make room for n more rows """
+        live = len(self)
+        if live + n > len(self.buf) // 2:
+            size = 2 * max(len(self.buf), live + n)
+            buf = np.empty(shape=(size, self.buf.shape[1]), dtype=self.buf.dtype)
+        else:
+            buf = self.buf
+        buf[:live] = self.buf[self.head:self.tail]
+        self.buf, self.head, self.tail = buf, 0, live
+
+    def retire(self, keep):
+        """ Drop the live rows for which the boolean array keep is False. """
+        first = np.argmax(keep) if keep.any() else len(keep)
+        if keep[first:].all():
+            # the usual case, rows are in time order
+            self.head += first
+        else:
+            live = self.rows[keep]
+            self.buf[:len(live)] = live
+            self.head, self.tail = 0, len(live)
 
-    fps = [open(f, 'r') for f in ctx.FILE]
-    gen = histogram_generator(ctx, fps, ctx.buff_size)
+def weighted_interval_data(ctx, printdirs, gen=None, start=None, stop=None):
+    """ Yield the interval_record() of the rows of gen, all the input files by
+        default.  The intervals begin at start, or at the one holding the
+        first row when start is None, and stop before the one beginning at
+        stop, if given. """
 
-    print(', '.join(columns))
+    if gen is None:
+        gen = histogram_generator(ctx, ctx.FILE, ctx.buff_size)
+    align = start is None
 
     try:
-        start, end = 0, ctx.interval
-        arr = np.empty(shape=(0,__TOTAL_COLUMNS + 1),dtype=int)
+        if align:
+            start = 0
+        end = start + ctx.interval
+        # with --sparse, the window holds the nonzero_entries() of the rows
+        window = RowBuffer(4 if ctx.sparse else ctx.total_columns + 1)
+        pending = np.empty(shape=(0, ctx.total_columns + 1), dtype=int)
+        first = last = None     # times of the first and the last row read
         more_data = True
-        while more_data or len(arr) > 0:
-
-            # Read up to ctx.max_latency (default 20 seconds) of data from end of current interval.
-            while len(arr) == 0 or arr[-1][0] < ctx.max_latency * 1000 + end:
-                try:
-                    new_arr = next(gen)
-                except StopIteration:
-                    more_data = False
-                    break
-                nashape  = new_arr.reshape((1,__TOTAL_COLUMNS + 1))
-                arr = np.append(arr, nashape, axis=0)
-            #arr = arr.astype(int)
-            
+        while (more_data or len(window) > 0) and (stop is None or start < stop):
+
+            # Read up to ctx.max_latency (default 20 seconds) of data from end of current interval:
+            # the rows up to and including the first one past that time.
+            limit = ctx.max_latency * 1000 + end
+            while last is None or last < limit:
+                if len(pending) == 0:
+                    pending = next(gen, None)
+                    if pending is None:
+                        pending = np.empty(shape=(0, ctx.total_columns + 1), dtype=int)
+                        more_data = False
+                        break
+                past = pending[:,0] >= limit
+                n = np.argmax(past) + 1 if past.any() else len(pending)
+                window.extend(nonzero_entries(pending[:n]) if ctx.sparse else pending[:n])
+                if first is None:
+                    first = pending[0][0]
+                last = pending[n - 1][0]
+                pending = pending[n:]
+
+            arr = window.rows
             if arr.size > 0:
                 # Jump immediately to the start of the input, rounding
                 # down to the nearest multiple of the interval (useful when --log_unix_epoch
                 # was used to create these histograms):
-                if start == 0 and arr[0][0] - ctx.max_latency > end:
-                    start = arr[0][0] - ctx.max_latency
+                if align and start == 0 and first - ctx.max_latency > end:
+                    start = first - ctx.max_latency
                     start = start - (start % ctx.interval)
                     end = start + ctx.interval
 
-                process_weighted_interval(ctx, arr, start, end, printdirs)
+                for record in process_weighted_interval(ctx, arr, start, end, printdirs):
+                    yield record
                 
-                # Update arr to throw away samples we no longer need - samples which
+                # Retire samples we no longer need - samples which
                 # end before the start of the next interval, i.e. the end of the
                 # current interval:
-                idx = np.where(arr[:,0] > end)
-                arr = arr[idx]
+                window.retire(arr[:,0] > end)
             
             start += ctx.interval
             end = start + ctx.interval
     finally:
-        for fp in fps:
-            fp.close()
-
-def output_interval_data(ctx,directions):
-    fps = [HistFileRdr(f) for f in ctx.FILE]
-
-    print(', '.join(columns))
-
-    start = 0
-    end = ctx.interval
-    while True:
-
-        more_data = False
-
-        # add bins from all files in target intervals
-        arr = None
-        numSamples = 0
-        while True:
-            foundSamples = False
-            for fp in fps:
-                ts = fp.curTS
-                if ts and ts+10 < end:  # shift sample time when very close to an end time
-                    curdirect = fp.curDir
-                    numSamples += 1
-                    foundSamples = True
-                    if arr is None:
-                        arr = {}
-                        for d in directions:
-                            arr[d] = np.zeros(shape=(__HIST_COLUMNS), dtype=int)
-                    if 'm' in arr:
-                        arr['m'] = np.add(arr['m'], fp.curBins)
-                    if 'r' in arr and curdirect == 0:
-                        arr['r'] = np.add(arr['r'], fp.curBins)
-                    if 'w' in arr and curdirect == 1:
-                        arr['w'] = np.add(arr['w'], fp.curBins)
-                    if 't' in arr and curdirect == 2:
-                        arr['t'] = np.add(arr['t'], fp.curBins)
-
-                    more_data = True
-                    fp.nextData()
-                elif ts:
-                    more_data = True
-
-            # reached end of all files
-            # or gone through all files without finding sample in interval
-            if not more_data or not foundSamples:
+        gen.close()
+
+# Time-sharded processing (-j).
+#
+# The statistics of an interval only depend on the rows later than its
+# start, up to the first row past --max_latency after its end.  So the
+# output intervals are cut into shards of consecutive intervals, which
+# worker processes reduce independently: each one reads just the rows of
+# its own intervals plus the --max_latency of rows after them, which
+# overlap the next shard.  The statistics of the shards are printed in
+# order, so the output is the same as that of a single process.
+#
+# To start reading a log near the beginning of a shard, log_index() samples
+# the time of one line every INDEX_STEP bytes of it, a sparse index of
+# byte offsets by time.  Logs with a valid cache are looked up in their
+# memory-mapped matrix instead, and compressed logs without one are read
+# from their start.
+
+INDEX_STEP = 1 << 16
+
+def line_time(line):
+    return int(line.split(b',', 1)[0])
+
+def log_index(fn):
+    """ Return the times of the lines starting at, or first after, every
+        multiple of INDEX_STEP bytes of the uncompressed log fn, their byte
+        offsets and the time of the last line of the log. """
+    times, offsets = [], []
+    last = None
+    with open(fn, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        for pos in range(0, size, INDEX_STEP):
+            if pos:
+                # skip to the start of the next line
+                f.seek(pos - 1)
+                f.readline()
+            off = f.tell()
+            line = f.readline().strip()
+            if not line:
                 break
-
-        if arr is not None:
-            #print("{} size({}) samples({}) nonzero({}):".format(end, arr.size, numSamples, np.count_nonzero(arr)), str(arr), )
-            for d in sorted(arr.keys()):
-                aval = arr[d]
-                process_interval(ctx, aval, end, d)
-
-        # reach end of all files
-        if not more_data:
-            break
-
-        start += ctx.interval
-        end = start + ctx.interval
-
-def main(ctx):
+            if not offsets or off > offsets[-1]:
+                times.append(line_time(line))
+                offsets.append(off)
+
+        tail, pos = b'', size
+        while pos > 0 and times:
+            n = min(pos, 1 << 16)
+            pos -= n
+            f.seek(pos)
+            tail = f.read(n) + tail
+            lines = tail.strip().split(b'\n')
+            if len(lines) > 1 or (pos == 0 and lines[0]):
+                last = line_time(lines[-1])
+                break
+    return times, offsets, last
+
+def log_extent(ctx, fn):
+    """ Return the times of the first and the last row of fn and its
+        sparse index, which is None for logs read from their start, or
+        None for an empty log. """
+    cache = load_cache(fn) if getattr(ctx, 'cache', True) else None
+    if cache is None and is_compressed(fn):
+        # decompress it once, which also builds its cache
+        first = last = None
+        for arr in read_hist_chunks(ctx, fn, ctx.buff_size):
+            if first is None:
+                first = arr[0][0]
+            last = arr[-1][0]
+        return None if first is None else (first, last, None)
+
+    if cache is not None:
+        extent = (cache.first_time, cache.last_time, None) if cache.rows > 0 else None
+    else:
+        times, offsets, last = log_index(fn)
+        extent = (times[0], last, (times, offsets)) if times else None
+    if extent is None and ctx.warn:
+        sys.stderr.write("WARNING: Empty input file encountered.\n")
+    return extent
+
+def log_range(index, after, until):
+    """ Return the read_hist_chunks arguments for reading the rows of the
+        log with the given sparse index which are later than after, up to
+        its first row at or past until; or all of them when until is None.
+        after may be None to read from the start. """
+    if index is None:
+        return after, 0, None
+    times, offsets = index
+    offset, end = 0, None
+    if after is not None:
+        i = np.searchsorted(times, after, side='right') - 1
+        if i >= 0:
+            offset = offsets[i]
+    if until is not None:
+        # up to the line after the first indexed one at or past until
+        i = np.searchsorted(times, until, side='left') + 1
+        if i < len(offsets):
+            end = offsets[i]
+    return after, offset, end
+
+def shard_tasks(ctx, printdirs):
+    """ Return the arguments of weighted_shard() for every shard of the
+        output intervals, about four per worker process. """
+    files, indexes = [], []
+    first = last = None
+    for fn in ctx.FILE:
+        extent = log_extent(ctx, fn)
+        if extent is None:
+            continue
+        files.append(fn)
+        indexes.append(extent[2])
+        first = extent[0] if first is None else min(first, extent[0])
+        last = extent[1] if last is None else max(last, extent[1])
+    if not files:
+        return []
+
+    # the first interval and the number of intervals of a serial run, see
+    # weighted_interval_data()
+    start = 0
+    if first - ctx.max_latency > ctx.interval:
+        start = first - ctx.max_latency
+        start = start - (start % ctx.interval)
+    count = max(1, -(-(last - start) // ctx.interval))
+
+    nshards = min(count, ctx.jobs * 4)
+    bounds = [start + (count * i // nshards) * ctx.interval for i in range(nshards)] + [None]
+    tasks = []
+    for i in range(nshards):
+        stop = bounds[i + 1]
+        until = None if stop is None else stop + ctx.max_latency * 1000
+        # as it reads the input from its start, the first shard finds the
+        # first interval itself like a serial run does
+        after = bounds[i] if i > 0 else None
+        starts = [log_range(index, after, until) for index in indexes]
+        tasks.append((ctx, printdirs, files, starts, after, stop))
+    return tasks
+
+def weighted_shard(task):
+    """ Return the interval records of a shard, in a worker process. """
+    ctx, printdirs, files, starts, start, stop = task
+    gen = histogram_generator(ctx, files, ctx.buff_size, starts)
+    return list(weighted_interval_data(ctx, printdirs, gen, start, stop))
+
+def sharded_interval_data(ctx, printdirs):
+    """ Yield the records of weighted_interval_data(), reducing the shards
+        of the output intervals in ctx.jobs worker processes. """
+    import multiprocessing
+    tasks = shard_tasks(ctx, printdirs)
+    pool = multiprocessing.Pool(ctx.jobs)
+    try:
+        for records in pool.imap(weighted_shard, tasks):
+            for record in records:
+                yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def file_interval_sums(ctx, fn, dirs, shift=0):
+    """ Yield the unweighted interval sums of the hist file fn, in order, as
+        (interval number, sums) pairs, where sums maps the directions of
+        dirs which have rows in the interval to the sum of their histograms.
+
+        A row belongs to the interval its time falls in, after shifting it
+        by 10 ms (so that rows very close to the end of an interval go to
+        the next one), and never to one before that of an earlier row.
+        The times are taken shift ms earlier than in the file.
+
+        The file is read in blocks of rows, which are sorted by interval
+        and direction with one stable sort.  Every run of rows of the same
+        interval and direction is then added up with a single np.add.reduce
+        call over its rows, which is several times faster than
+        np.add.reduceat over the block as a whole.
+    """
+    cur = None      # interval number and sums of the last interval read
+    last = 0        # and the number of its interval
+    for arr in read_hist_chunks(ctx, fn, ctx.buff_size):
+        ids = np.maximum.accumulate(np.r_[last, (arr[:,0] - shift + 10) // ctx.interval])[1:]
+        last = ids[-1]
+        rdirs, hists = arr[:,1], arr[:,3:]
+        if dirs != ['m']:
+            order = np.lexsort((rdirs, ids))
+            ids, rdirs, hists = ids[order], rdirs[order], hists[order]
+            new_run = (ids[1:] != ids[:-1]) | (rdirs[1:] != rdirs[:-1])
+        else:
+            new_run = ids[1:] != ids[:-1]
+        bounds = np.r_[0, np.flatnonzero(new_run) + 1, len(ids)].tolist()
+
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            k = ids[a]
+            if cur is None or cur[0] != k:
+                if cur is not None:
+                    yield cur
+                cur = (k, {})
+            sums = cur[1]
+            run = np.add.reduce(hists[a:b], axis=0)
+            for d in dirs:
+                if d == 'm' or rdirs[a] == dir_map.index(d):
+                    sums[d] = run if d not in sums else sums[d] + run
+
+    if cur is not None:
+        yield cur
+
+def interval_data(ctx, directions):
+    """ Yield the interval_record() of the unweighted intervals, adding every
+        row to its interval (see file_interval_sums()).  The interval sums
+        of the files are merged in interval order, so only one block of
+        rows and one interval per file are held at a time.  With --hosts,
+        the times of each file are shifted as in host_shifts().
+    """
+    dirs = sorted(directions)
+    cur = None
+    shifts = dict((fn, 0) for fn in ctx.FILE)
+    if getattr(ctx, 'hosts', False):
+        groups = host_groups(ctx)
+        for host, shift in host_shifts(ctx, groups)[0].items():
+            for fn in groups[host]:
+                shifts[fn] = shift
+
+    def numbered(i, fn):
+        # the file number keeps sums of the same interval from being compared
+        for k, sums in file_interval_sums(ctx, fn, dirs, shifts[fn]):
+            yield k, i, sums
+
+    def interval_records(k, sums):
+        for d in dirs:
+            if d in sums:
+                record = process_interval(ctx, sums[d], (k + 1) * ctx.interval, d)
+                if record is not None:
+                    yield record
+
+    for k, _, sums in heapq.merge(*[numbered(i, fn) for i, fn in enumerate(ctx.FILE)]):
+        if cur is not None and cur[0] == k:
+            for d, hist in sums.items():
+                cur[1][d] = hist if d not in cur[1] else cur[1][d] + hist
+            continue
+        if cur is not None:
+            for record in interval_records(*cur):
+                yield record
+        cur = (k, sums)
+
+    if cur is not None:
+        for record in interval_records(*cur):
+            yield record
+
+# Logs of many hosts (--hosts).
+#
+# In client/server mode, the fio client saves the logs of every server as
+# "<log name>.<hostname>".  With --hosts, the logs are grouped by host,
+# taken from their file names with --host_pattern, and the rows of each
+# host are shifted so that its first row comes at the time of the earliest
+# first row of all hosts: with log_unix_epoch, every host stamps its rows
+# with its own clock, and the offsets between the clocks would otherwise
+# smear each interval of a host over its neighbours.
+#
+# The logs of every host are then reduced in turn to the histograms of its
+# intervals, of which only the nonzero bins are kept, and those of all the
+# hosts are added up interval by interval.  As the weighted histogram of an
+# interval is a sum over rows, this gives the statistics of a merge of all
+# the rows.  But rows are only merged among the logs of one host, only the
+# logs of one host are open at a time, and the memory held goes with the
+# number of hosts and intervals rather than the rows in the window of all
+# hosts.  With -j, the hosts are reduced in parallel.
+
+HOST_PATTERN = r'\.log\.(.+)$'
+
+def host_groups(ctx):
+    """ Return the input files of every host, in order of first appearance,
+        the host of a file being the first group of --host_pattern matched
+        in its name. """
+    pattern = re.compile(ctx.host_pattern)
+    groups = collections.OrderedDict()
+    for fn in ctx.FILE:
+        m = pattern.search(os.path.basename(fn))
+        if m is None or not m.groups():
+            errmsg = ("Unable to tell the host of '%s' with --host_pattern '%s'\n" %
+                      (fn, ctx.host_pattern))
+            if runascmd:
+                err(errmsg)
+                exit(1)
+            raise RuntimeError(errmsg)
+        groups.setdefault(m.group(1), []).append(fn)
+    return groups
+
+def first_time(fn):
+    """ Return the time of the first row of the log fn, or None if it is
+        empty. """
+    with open_log(fn) as fp:
+        line = fp.readline().strip()
+    return line_time(line) if line else None
+
+def host_shifts(ctx, groups):
+    """ Return the number of ms to subtract from the times of the rows of
+        every host of groups, to align its first row with the earliest one
+        of all hosts (no shifts with --no-align), and that earliest time. """
+    firsts = {}
+    for host, files in groups.items():
+        times = [t for t in map(first_time, files) if t is not None]
+        if times:
+            firsts[host] = min(times)
+    base = min(firsts.values()) if firsts else 0
+    if not ctx.host_align:
+        return dict((host, 0) for host in groups), base
+    return dict((host, firsts.get(host, base) - base) for host in groups), base
+
+def host_records(ctx, printdirs, files, shift, start):
+    """ Yield the interval records of the logs of one host, whose times
+        are shifted by shift ms, from the interval beginning at start; ctx
+        must be a partial one (see host_interval_data()). """
+    gen = histogram_generator(ctx, files, ctx.buff_size, shifts=[shift] * len(files))
+    return weighted_interval_data(ctx, printdirs, gen, start)
+
+def reduce_host(task):
+    """ Return the interval records of a host, in a worker process. """
+    return list(host_records(*task))
+
+def merged_record(ctx, end, dir, samples, hists):
+    """ Return the interval_record() of the sum of the IntervalHist hists,
+        which hold samples samples in all. """
+    bins = np.concatenate([h.bins for h in hists]).astype(np.int64)
+    ws = np.concatenate([h.weights for h in hists])
+    nbins = len(ctx.bin_vals)
+    hist = sparse_hist(bins, ws, nbins) if ctx.sparse else None
+    if hist is None:
+        hist = None, np.bincount(bins, weights=ws, minlength=nbins)
+    return interval_record(ctx, end, min(h.min for h in hists), samples, hist[0], hist[1],
+                           max(h.max for h in hists), dir)
+
+def host_interval_data(ctx, printdirs):
+    """ Return a generator of the interval_record() of every interval and
+        direction, adding up the interval histograms of the hosts of the
+        input files. """
+    groups = host_groups(ctx)
+    shifts, first = host_shifts(ctx, groups)
+    # all hosts start at the first interval of a serial run (see
+    # weighted_interval_data()), rather than each finding its own
+    start = 0
+    if first - ctx.max_latency > ctx.interval:
+        start = first - ctx.max_latency
+        start = start - (start % ctx.interval)
+    hctx = copy.copy(ctx)
+    hctx.partial = True
+    tasks = [(hctx, printdirs, files, shifts[host], start) for host, files in groups.items()]
+    return merged_hosts(ctx, tasks)
+
+def merged_hosts(ctx, tasks):
+    """ Yield the sums of the interval records of the host_records() tasks,
+        once all hosts are reduced, in ctx.jobs worker processes with -j. """
+    if ctx.jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(ctx.jobs)
+        try:
+            hosts = pool.map(reduce_host, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        hosts = [reduce_host(task) for task in tasks]
+
+    def keyed(i, records):
+        # the host number keeps histograms of the same interval from being
+        # compared
+        for stats, hist in records:
+            yield stats.end, stats.dir, i, stats.samples, hist
+
+    merged = heapq.merge(*[keyed(i, records) for i, records in enumerate(hosts)])
+    for (end, dir), group in itertools.groupby(merged, key=lambda r: r[:2]):
+        group = list(group)
+        yield merged_record(ctx, end, dir, sum(r[3] for r in group), [r[4] for r in group])
+
+# Interval histogram stores.
+#
+# With --store, the histogram of every output interval and direction is
+# saved along with the statistics, so that --query can compute other
+# percentiles, coarser intervals or a time range of them later without
+# reading and weighting the logs again.  A store holds, behind a header:
+#
+#   - the value of every bin, as in bin_vals;
+#   - the (bin, weight) pairs of the nonzero bins of all the histograms;
+#   - a row of (end, direction, samples, min, max, first pair) per
+#     histogram, where min and max are not divided by --divisor.
+#
+# all as native float64 arrays, which --query memory-maps.
+
+STORE_MAGIC = b'FIOHSTO1'
+STORE_HEADER = len(STORE_MAGIC) + 6 * 8
+STORE_DIRS = 'rwtm'
+
+class StoreWriter(object):
+    """ Write the IntervalHist records of a run to the store fn, which is
+        only replaced by the new one on commit(). """
+    def __init__(self, fn, ctx):
+        self.fn = fn
+        self.interval = ctx.interval
+        self.directions = ctx.directions or ''
+        self.records = []
+        self.entries = 0
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(fn) or '.', prefix='.fiohist')
+        self.f = os.fdopen(fd, 'wb')
+        # mkstemp() creates the file readable by its owner only; like the
+        # log caches, the store gets the permissions of the (first) log
+        os.chmod(self.tmp, stat.S_IMODE(os.stat(ctx.FILE[0]).st_mode) & 0o666)
+        self.f.write(b'\0' * STORE_HEADER)
+        self.nbins = len(ctx.bin_vals)
+        self.f.write(np.asarray(ctx.bin_vals, dtype=np.float64).tobytes())
+
+    def add(self, stats, hist):
+        self.records.append((stats.end, STORE_DIRS.index(stats.dir), stats.samples,
+                             hist.min, hist.max, self.entries))
+        pairs = np.column_stack((hist.bins, hist.weights)).astype(np.float64)
+        self.f.write(pairs.tobytes())
+        self.entries += len(pairs)
+
+    def commit(self):
+        self.f.write(np.array(self.records, dtype=np.float64).tobytes())
+        dirs = sum(1 << STORE_DIRS.index(d) for d in self.directions)
+        self.f.seek(0)
+        self.f.write(STORE_MAGIC)
+        self.f.write(np.array([self.interval, dirs, self.nbins, self.entries,
+                               len(self.records), 0], dtype=np.int64).tobytes())
+        self.f.close()
+        self.f = None
+        os.rename(self.tmp, self.fn)
+
+    def abort(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            os.unlink(self.tmp)
+
+class HistStore(object):
+    """ A store written with --store, whose arrays are memory-mapped. """
+    def __init__(self, fn):
+        with open(fn, 'rb') as f:
+            header = f.read(STORE_HEADER)
+        if len(header) != STORE_HEADER or header[:len(STORE_MAGIC)] != STORE_MAGIC:
+            raise ValueError('%s: not a histogram store written with --store' % fn)
+        fields = np.frombuffer(header[len(STORE_MAGIC):], dtype=np.int64)
+        self.interval, dirs, nbins, entries, records = [int(x) for x in fields[:5]]
+        self.directions = ''.join(d for i, d in enumerate(STORE_DIRS) if dirs & (1 << i))
+        offset = STORE_HEADER
+        self.bin_vals = np.memmap(fn, dtype=np.float64, mode='r', offset=offset, shape=(nbins,))
+        offset += nbins * 8
+        self.entries = np.memmap(fn, dtype=np.float64, mode='r', offset=offset,
+                                 shape=(entries, 2)) if entries else np.empty((0, 2))
+        offset += entries * 16
+        self.records = np.memmap(fn, dtype=np.float64, mode='r', offset=offset,
+                                 shape=(records, 6)) if records else np.empty((0, 6))
+
+def query_records(ctx, directions):
+    """ Return a generator of the interval_record() of every interval and
+        direction of the store ctx.FILE[0] within --range, merging its
+        intervals into the --interval ones, which must be multiples of
+        them.  The histograms of the merged intervals are added up; so are
+        their sample counts, and the min and max are those of all of them. """
+    store = HistStore(ctx.FILE[0])
+    missing = [d for d in directions if d not in (store.directions or 'm')]
+    if missing or ctx.interval % store.interval:
+        errmsg = ("The store '%s' holds intervals of %d ms for directions '%s', "
+                  "which cannot give --interval %d and --directions %s\n" %
+                  (ctx.FILE[0], store.interval, store.directions or 'm', ctx.interval,
+                   ''.join(sorted(directions))))
+        if runascmd:
+            err(errmsg)
+            exit(1)
+        raise RuntimeError(errmsg)
+    return stored_intervals(ctx, store, directions)
+
+def stored_intervals(ctx, store, directions):
+    recs, entries = np.asarray(store.records), np.asarray(store.entries)
+    firsts = recs[:,5].astype(np.int64)
+    lasts = np.r_[firsts[1:], len(entries)]
+    ends = recs[:,0].astype(np.int64)
+    dirs = np.array([STORE_DIRS[int(d)] for d in recs[:,1]], dtype='U1')
+    sel = np.isin(dirs, list(directions))
+    start, stop = [None if not t else int(t) for t in (ctx.range or ':').split(':')]
+    if start is not None:
+        sel &= ends > start
+    if stop is not None:
+        sel &= ends <= stop
+    idx = np.flatnonzero(sel)
+
+    # output end time of every record; the output is sorted by end time and
+    # then by direction, as in a run over the logs
+    ends = -(-ends[idx] // ctx.interval) * ctx.interval
+    dirs = dirs[idx]
+    order = np.lexsort((dirs, ends))
+    idx, ends, dirs = idx[order], ends[order], dirs[order]
+    bounds = np.r_[0, np.flatnonzero((ends[1:] != ends[:-1]) | (dirs[1:] != dirs[:-1])) + 1, len(idx)]
+
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        group = idx[a:b]
+        hists = [IntervalHist(recs[i,3], recs[i,4], entries[firsts[i]:lasts[i],0],
+                              entries[firsts[i]:lasts[i],1]) for i in group]
+        yield merged_record(ctx, int(ends[a]), str(dirs[a]), int(recs[group,2].sum()), hists)
+
+def write_store(ctx, records):
+    """ Yield the given interval records, saving their histograms in the
+        store ctx.store, which is written once all have been read, or when
+        --follow is interrupted. """
+    writer = StoreWriter(ctx.store, ctx)
+    try:
+        try:
+            for stats, hist in records:
+                writer.add(stats, hist)
+                yield stats, hist
+        except KeyboardInterrupt:
+            if not ctx.follow:
+                raise
+        writer.commit()
+    finally:
+        writer.abort()
+
+def setup(ctx):
+    """ Fill in the defaults of ctx, detect the histogram layout of the
+        input files and return the set of directions to output. """
+    store = None
+    if getattr(ctx, 'query', False):
+        # the defaults are those the store was written with
+        store = HistStore(ctx.FILE[0])
+        if ctx.interval is None:
+            ctx.interval = store.interval
+        if ctx.directions is None and store.directions:
+            ctx.directions = store.directions
 
     if ctx.job_file:
         try:
@@ -505,20 +1190,45 @@ def main(ctx):
 
     gen_output_columns(ctx)
 
+    # the bins are kept in ctx rather than in globals, so that readers
+    # of logs with different bins do not disturb each other
+    if store is not None:
+        ctx.bin_vals = np.array(store.bin_vals)
+    elif getattr(ctx, 'follow', False):
+        compressed = [fn for fn in ctx.FILE if is_compressed(fn)]
+        errmsg = None
+        if compressed:
+            errmsg = "--follow cannot read compressed log '%s'\n" % compressed[0]
+        elif getattr(ctx, 'hosts', False):
+            errmsg = "--follow cannot be combined with --hosts\n"
+        if errmsg:
+            if runascmd:
+                err(errmsg)
+                exit(1)
+            raise RuntimeError(errmsg)
+        # wait for fio to write the first line
+        watcher = LogWatcher(ctx.FILE[0])
+        try:
+            while True:
+                with open(ctx.FILE[0], 'rb') as fp:
+                    line = fp.readline()
+                if line.endswith(b'\n') or not watcher.wait(len(line), ctx.follow_timeout):
+                    break
+        finally:
+            watcher.close()
 
     # Automatically detect how many columns are in the input files,
     # calculate the corresponding 'coarseness' parameter used to generate
     # those files, and calculate the appropriate bin latency values:
-    with open(ctx.FILE[0], 'r') as fp:
-        global bin_vals,lower_bin_vals,upper_bin_vals,__HIST_COLUMNS,__TOTAL_COLUMNS
-        __TOTAL_COLUMNS = len(fp.readline().split(','))
-        __HIST_COLUMNS = __TOTAL_COLUMNS - __NON_HIST_COLUMNS
+    if store is None:
+        with open_log(ctx.FILE[0]) as fp:
+            ctx.total_columns = len(fp.readline().split(b','))
+        hist_cols = ctx.total_columns - __NON_HIST_COLUMNS
 
-        max_cols = guess_max_from_bins(ctx, __HIST_COLUMNS)
-        coarseness = int(np.log2(float(max_cols) / __HIST_COLUMNS))
-        bin_vals = np.array([plat_idx_to_val_coarse(x, coarseness) for x in np.arange(__HIST_COLUMNS)], dtype=float)
-        lower_bin_vals = np.array([plat_idx_to_val_coarse(x, coarseness, 0.0) for x in np.arange(__HIST_COLUMNS)], dtype=float)
-        upper_bin_vals = np.array([plat_idx_to_val_coarse(x, coarseness, 1.0) for x in np.arange(__HIST_COLUMNS)], dtype=float)
+        max_cols = guess_max_from_bins(ctx, hist_cols)
+        coarseness = int(np.log2(float(max_cols) / hist_cols))
+        table = bin_table(max_cols >> 6, 6, coarseness)[:, :hist_cols]
+        ctx.lower_bin_vals, ctx.bin_vals, ctx.upper_bin_vals = table
 
     # indicate which directions to output (read(0), write(1), trim(2), mixed(3))
     directions = set()
@@ -526,16 +1236,66 @@ def main(ctx):
     if ctx.directions and 'r' in ctx.directions:    directions.add('r')
     if ctx.directions and 'w' in ctx.directions:    directions.add('w')
     if ctx.directions and 't' in ctx.directions:    directions.add('t')
-
-    if ctx.noweight:
-        output_interval_data(ctx, directions)
+    return directions
+
+def interval_records(ctx):
+    """ Yield the interval_record() of every output interval and direction. """
+    directions = setup(ctx)
+    if getattr(ctx, 'query', False):
+        return query_records(ctx, directions)
+    elif ctx.noweight:
+        return interval_data(ctx, directions)
+    elif getattr(ctx, 'hosts', False):
+        return host_interval_data(ctx, directions)
+    elif ctx.jobs > 1 and not ctx.follow:
+        return sharded_interval_data(ctx, directions)
     else:
-        output_weighted_interval_data(ctx, directions)
+        return weighted_interval_data(ctx, directions)
 
+def interval_stats(ctx):
+    """ Yield the IntervalStats of every output interval and direction. """
+    return (stats for stats, _ in interval_records(ctx))
 
-if __name__ == '__main__':
+def main(ctx):
+    records = interval_records(ctx)
+    print(', '.join(ctx.columns))
+    if ctx.store:
+        records = write_store(ctx, records)
+    try:
+        for stats, _ in records:
+            print_all_stats(ctx, stats)
+            if ctx.follow:
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        if not ctx.follow:
+            raise
+
+class HistReader(object):
+    """ Iterate over the IntervalStats of a set of histogram logs, which are
+        read as the reader is consumed.  The keyword options are named like
+        the destinations of the command line options (interval, noweight,
+        divisor, percentiles, directions, usbin, group_nr, store, query, ...),
+        with their defaults. """
+    def __init__(self, files, **options):
+        if isinstance(files, str):
+            files = [files]
+        self.ctx = build_parser().parse_args(['--'] + list(files))
+        for name, value in options.items():
+            if name == 'FILE' or not hasattr(self.ctx, name):
+                raise TypeError('unknown option %r' % name)
+            setattr(self.ctx, name, value)
+        if not isinstance(self.ctx.percentiles, str):
+            self.ctx.percentiles = ','.join([str(p) for p in self.ctx.percentiles])
+
+    def __iter__(self):
+        records = interval_records(self.ctx)
+        if self.ctx.store:
+            records = write_store(self.ctx, records)
+        for stats, _ in records:
+            yield stats
+
+def build_parser():
     import argparse
-    runascmd = True
     p = argparse.ArgumentParser()
     arg = p.add_argument
     arg("FILE", help='space separated list of latency log filenames', nargs='+')
@@ -558,6 +1318,13 @@ if __name__ == '__main__':
         default=False,
         help='do not perform weighting of samples between output intervals')
 
+    arg('-j', '--jobs',
+        default=1,
+        type=int,
+        help='number of worker processes reducing shards of the output '
+             'intervals, or hosts with --hosts, in parallel (ignored with '
+             '--noweight and --follow)')
+
     arg('-d', '--divisor',
         required=False,
         type=int,
@@ -598,6 +1365,68 @@ if __name__ == '__main__':
         action='store_true',
         help='histogram bin latencies are in us (fio versions < 2.99. fio uses ns for version >= 2.99')
 
+    arg('--follow',
+        action='store_true',
+        default=False,
+        help='read the logs while fio is still writing them, printing each '
+             'interval once all logs are --max_latency past its end')
+
+    arg('--follow_timeout',
+        default=None,
+        type=float,
+        help='with --follow, consider a log complete once it has not grown '
+             'for this many seconds (default: follow until interrupted)')
+
+    arg('--sparse',
+        action='store_true',
+        default=False,
+        help='compute the percentiles of an interval from its nonzero bins '
+             'only, unless more than %d%%%% of the bins are used' % (SPARSE_DENSITY * 100))
+
+    arg('--hosts',
+        action='store_true',
+        default=False,
+        help='group the logs by host, align the clocks of the hosts on their '
+             'first rows, and reduce the logs of each host on its own before '
+             'adding up the hosts (-j reduces hosts in parallel)')
+
+    arg('--host_pattern',
+        default=HOST_PATTERN,
+        type=str,
+        help='with --hosts, regular expression whose first group, searched '
+             'in the name of a log, is its host (default: the suffix after '
+             '".log.", as the fio client names logs)')
+
+    arg('--no-align',
+        dest='host_align',
+        action='store_false',
+        default=True,
+        help='with --hosts, do not shift the times of the hosts')
+
+    arg('--store',
+        default=None,
+        type=str,
+        help='save the histogram of every output interval and direction in '
+             'this file, for later runs with --query')
+
+    arg('--query',
+        action='store_true',
+        default=False,
+        help='compute the statistics from the histogram store given as FILE, '
+             'written with --store, rather than from logs')
+
+    arg('--range',
+        default=None,
+        type=str,
+        help='with --query, only use the intervals with end-times in '
+             'START:END (ms), where either may be left out')
+
+    arg('--no-cache',
+        dest='cache',
+        action='store_false',
+        default=True,
+        help='do not read or write the parsed log cache files')
+
     arg('--directions',
         default=None,
         type=str,
@@ -608,5 +1437,9 @@ if __name__ == '__main__':
              'adds a "dir" field to the output content, and separate rows for each of the indicated '
              'directions.')
 
-    main(p.parse_args())
+    return p
+
+if __name__ == '__main__':
+    runascmd = True
+    main(build_parser().parse_args())
 